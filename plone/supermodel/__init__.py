@@ -1,45 +1,130 @@
 # -*- coding: utf-8 -*-
 from io import BytesIO
+from plone.supermodel import cache
+from plone.supermodel import compiled
 from plone.supermodel import model
 from plone.supermodel import parser
 from plone.supermodel import serializer
 from plone.supermodel import utils
+from plone.supermodel.diff import diffModels
 from plone.supermodel.interfaces import FILENAME_KEY
 from plone.supermodel.interfaces import IXMLToSchema
 from zope.interface import moduleProvides
+import hashlib
 
-# Cache models by absolute filename
-_model_cache = {}
+# Cache models by absolute filename. Entries are revalidated against the
+# file on disk, and the least recently used ones are dropped once the cache
+# holds more than maxEntries models.
+_model_cache = cache.ModelCache(maxEntries=1000)
 
+# Models parsed by loadString(..., cached=True), keyed by a digest of the
+# XML and the policy name.
+_string_cache = cache.LRUCache(maxEntries=1000)
 
-def xmlSchema(filename, schema=u"", policy=u"", _frame=2):
-    _model = loadFile(filename, policy=policy, _frame=_frame + 1)
+
+def xmlSchema(filename, schema=u"", policy=u"", lazy=False, _frame=2):
+    _model = loadFile(filename, policy=policy, lazy=lazy, _frame=_frame + 1)
     return _model.schemata[schema]
 
 
-def loadFile(filename, reload=False, policy=u"", _frame=2):
-    global _model_cache
+def loadFile(filename, reload=False, policy=u"", lazy=False, _frame=2):
     path = utils.relativeToCallingPackage(filename, _frame)
-    if reload or path not in _model_cache:
-        parsed_model = parser.parse(path, policy=policy)
+    if reload:
+        _model_cache.invalidate(path)
+
+    def setFilename(schemaName, schema):
+        schema.setTaggedValue(FILENAME_KEY, path)
+
+    def loader(path):
+        if lazy:
+            # Compiled models hold all schemata, so they are not used here
+            parsed_model = parser.parse(path, policy=policy, lazy=True)
+            parsed_model.schemata.onLoad.append(setFilename)
+            return parsed_model
+
+        parsed_model = compiled.parseFile(path, policy=policy)
+        for schemaName, schema in parsed_model.schemata.items():
+            setFilename(schemaName, schema)
+        return parsed_model
+
+    _model = _model_cache.load(path, loader)
+    if not lazy:
+        _loadAll(_model)
+    return _model
+
+
+def _loadAll(_model):
+    # A lazy model cached by an earlier call is shared with eager callers,
+    # who must get all schemata constructed and errors reported up front.
+    if isinstance(_model.schemata, parser.LazySchemata):
+        _model.schemata.loadAll()
+
+
+def loadFiles(filenames, policy=u"", workers=None, _frame=2):
+    paths = [utils.relativeToCallingPackage(filename, _frame)
+             for filename in filenames]
+
+    models = {}
+    signatures = {}
+    for path in paths:
+        if path in models or path in signatures:
+            continue
+        cached_model = _model_cache.lookup(path)
+        if cached_model is not None:
+            _loadAll(cached_model)
+            models[path] = cached_model
+        else:
+            signatures[path] = _model_cache.signature(path)
+
+    missing = list(signatures.keys())
+    parsed_models = compiled.parseFiles(missing, policy=policy,
+                                        workers=workers)
+    for path, parsed_model in zip(missing, parsed_models):
         for schema in parsed_model.schemata.values():
             schema.setTaggedValue(FILENAME_KEY, path)
-        _model_cache[path] = parsed_model
-    return _model_cache[path]
+        _model_cache.store(path, parsed_model, signatures[path])
+        models[path] = parsed_model
+
+    return [models[path] for path in paths]
+
 
+def invalidateFile(filename=None, _frame=2):
+    if filename is None:
+        _model_cache.invalidate()
+    else:
+        path = utils.relativeToCallingPackage(filename, _frame)
+        _model_cache.invalidate(path)
 
-def loadString(model, policy=u""):
+
+def loadString(model, policy=u"", cached=False):
     if isinstance(model, str) and not isinstance(model, bytes):
         model = model.encode('utf-8')
-    return parser.parse(BytesIO(model), policy=policy)
+    if not cached:
+        return parser.parse(BytesIO(model), policy=policy)
+
+    key = (hashlib.sha1(model).hexdigest(), policy)
+    parsed_model = _string_cache.get(key)
+    if parsed_model is None:
+        parsed_model = parser.parse(BytesIO(model), policy=policy)
+        _string_cache.set(key, parsed_model, len(model))
+    # The schemata are shared, but the mapping is the caller's own.
+    return parsed_model.__class__(dict(parsed_model.schemata))
+
+
+def loadJSON(data, policy=u""):
+    return parser.parseJSON(data, policy=policy)
+
+
+def serializeSchema(schema, name=u"", mode=serializer.COMPAT):
+    return serializeModel(model.Model({name: schema}), mode=mode)
 
 
-def serializeSchema(schema, name=u""):
-    return serializeModel(model.Model({name: schema}))
+def serializeModel(model, mode=serializer.COMPAT):
+    return serializer.serialize(model, mode=mode)
 
 
-def serializeModel(model):
-    return serializer.serialize(model)
+def serializeModelJSON(model):
+    return serializer.serializeJSON(model)
 
 
 moduleProvides(IXMLToSchema)
@@ -47,7 +132,12 @@ moduleProvides(IXMLToSchema)
 __all__ = (
     'xmlSchema',
     'loadFile',
+    'loadFiles',
+    'invalidateFile',
     'loadString',
+    'loadJSON',
     'serializeSchema',
-    'serializeModel'
+    'serializeModel',
+    'serializeModelJSON',
+    'diffModels',
 )
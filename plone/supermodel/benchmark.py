@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for parsing, serializing and finalizing schemata.
+
+Run with:
+
+    python -m plone.supermodel.benchmark [--save FILE] [--compare FILE]
+
+Each phase is run on synthetic models of a few different shapes. The best
+time out of a number of repetitions and, on Python 3, the peak memory
+allocated are reported. Results can be saved as JSON and compared against
+later runs.
+"""
+from io import BytesIO
+from io import StringIO
+from plone.supermodel import parser
+from plone.supermodel import serializer
+from plone.supermodel.interfaces import XML_NAMESPACE
+from plone.supermodel.interfaces import SECURITY_NAMESPACE
+from plone.supermodel.interfaces import I18N_NAMESPACE
+from plone.supermodel.model import Schema
+from plone.supermodel.model import SchemaClass
+from plone.supermodel.model import _finalizedSchemas
+from plone.supermodel.model import finalizeSchemas
+import argparse
+import gc
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# Model shapes: name -> arguments to generateModel()
+SHAPES = (
+    ('small', dict(schemata=1, fields=10)),
+    ('wide', dict(schemata=1, fields=500, fieldsets=10)),
+    ('many', dict(schemata=100, fields=20, fieldsets=2)),
+    ('vocabularies', dict(schemata=1, fields=20, choiceValues=2000)),
+    ('nested', dict(schemata=10, fields=50, nested=True)),
+    ('security', dict(schemata=10, fields=50, security=True)),
+)
+
+PHASES = ('parse', 'serialize', 'schemaclass', 'finalize')
+
+
+def generateModel(schemata=1, fields=10, fieldsets=0, choiceValues=10,
+                  nested=False, security=False):
+    """Return the XML for a synthetic model with the given number of
+    schemata, each with the given number of fields spread over the given
+    number of fieldsets (plus the default one).
+
+    Fields cycle through a few common types, including Choice fields with
+    choiceValues values. If nested is True, List and Dict fields with
+    nested value types are included. If security is True, every field gets
+    read and write permissions.
+    """
+    out = StringIO()
+    out.write(u'<model xmlns="%s" xmlns:security="%s" xmlns:i18n="%s" '
+              u'i18n:domain="plone.supermodel.benchmark">\n' %
+              (XML_NAMESPACE, SECURITY_NAMESPACE, I18N_NAMESPACE))
+
+    def writeField(schemaIndex, index):
+        name = u"field_%d_%d" % (schemaIndex, index)
+        kind = index % (6 if nested else 4)
+        attributes = u''
+        if security:
+            attributes = (u' security:read-permission="zope2.View"'
+                          u' security:write-permission="cmf.ModifyPortalContent"')
+        if kind == 0:
+            fieldType = u'zope.schema.TextLine'
+            body = (u'<title i18n:translate="">Title %d</title>'
+                    u'<max_length>200</max_length>' % index)
+        elif kind == 1:
+            fieldType = u'zope.schema.Int'
+            body = (u'<title>Number %d</title><min>0</min><max>1000</max>'
+                    u'<default>%d</default>' % (index, index))
+        elif kind == 2:
+            fieldType = u'zope.schema.Choice'
+            body = u'<title>Choice %d</title><values>%s</values>' % (
+                index,
+                u''.join([u'<element>value%d</element>' % i
+                          for i in range(choiceValues)])
+            )
+        elif kind == 3:
+            fieldType = u'zope.schema.Bool'
+            body = (u'<title>Flag %d</title><required>False</required>'
+                    u'<default>True</default>' % index)
+        elif kind == 4:
+            fieldType = u'zope.schema.List'
+            body = (u'<title>List %d</title>'
+                    u'<value_type type="zope.schema.Int"><min>0</min>'
+                    u'</value_type>'
+                    u'<default><element>1</element><element>2</element>'
+                    u'</default>' % index)
+        else:
+            fieldType = u'zope.schema.Dict'
+            body = (u'<title>Dict %d</title>'
+                    u'<key_type type="zope.schema.TextLine" />'
+                    u'<value_type type="zope.schema.List">'
+                    u'<value_type type="zope.schema.TextLine" />'
+                    u'</value_type>' % index)
+        out.write(u'<field name="%s" type="%s"%s>%s</field>\n' %
+                  (name, fieldType, attributes, body))
+
+    for schemaIndex in range(schemata):
+        out.write(u'<schema name="schema_%d">\n' % schemaIndex)
+        perFieldset = fields // (fieldsets + 1)
+        index = 0
+        for index in range(fields - perFieldset * fieldsets):
+            writeField(schemaIndex, index)
+        for fieldsetIndex in range(fieldsets):
+            out.write(u'<fieldset name="fieldset_%d" label="Fieldset %d">\n' %
+                      (fieldsetIndex, fieldsetIndex))
+            for i in range(perFieldset):
+                index += 1
+                writeField(schemaIndex, index)
+            out.write(u'</fieldset>\n')
+        out.write(u'</schema>\n')
+
+    out.write(u'</model>\n')
+    return out.getvalue().encode('utf-8')
+
+
+def configure():
+    """Load the configuration of plone.supermodel, including the security
+    metadata handler.
+    """
+    from plone.supermodel.interfaces import IFieldMetadataHandler
+    from plone.supermodel.security import SecuritySchema
+    from zope.component import provideUtility
+    from zope.configuration import xmlconfig
+    xmlconfig.xmlconfig(StringIO(u"""\
+<configure xmlns="http://namespaces.zope.org/zope">
+    <include package="zope.component" file="meta.zcml" />
+    <include package="plone.supermodel" />
+</configure>
+"""))
+    provideUtility(SecuritySchema(), IFieldMetadataHandler,
+                   name=u"plone.supermodel.security")
+
+
+def measure(func, repeat, setup=None):
+    """Call func repeat times and return a dict with the best and mean time
+    in seconds, and the peak memory allocated during one call, in bytes.
+    If given, setup is called before each call to func, and is not timed.
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    peak = None
+    if tracemalloc is not None:
+        if setup is not None:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'peak': peak,
+    }
+
+
+def benchmarkShape(xml, repeat):
+    """Return the results of all phases for the model in xml.
+    """
+    model = parser.parse(BytesIO(xml))
+    specs = [
+        (schema.__name__, schema.__bases__, dict(
+            (name, schema[name]) for name in schema.names()
+        ))
+        for schema in model.schemata.values()
+    ]
+
+    def buildSchemata():
+        for name, bases, attrs in specs:
+            SchemaClass(name, bases, attrs=dict(attrs))
+
+    return {
+        'parse': measure(lambda: parser.parse(BytesIO(xml)), repeat),
+        'serialize': measure(lambda: serializer.serialize(model), repeat),
+        'schemaclass': measure(buildSchemata, repeat),
+        # finalizeSchemas() skips schemata that are already finalized, so
+        # clear the markers in order to time the plugins being run.
+        'finalize': measure(lambda: finalizeSchemas(Schema), repeat,
+                            setup=_clearFinalized),
+    }
+
+
+def _clearFinalized():
+    _finalizedSchemas().clear()
+
+
+def run(shapes=SHAPES, repeat=5):
+    """Run all benchmarks and return the results, keyed by shape and then
+    phase.
+    """
+    results = {}
+    for name, options in shapes:
+        results[name] = benchmarkShape(generateModel(**options), repeat)
+    return results
+
+
+def report(results, baseline=None, out=sys.stdout):
+    """Print the results, compared with the baseline results if given.
+    """
+    out.write('%-14s %-12s %12s %12s %12s\n' %
+              ('shape', 'phase', 'best (ms)', 'peak (KiB)', 'vs. baseline'))
+    for name, options in SHAPES:
+        if name not in results:
+            continue
+        for phase in PHASES:
+            result = results[name][phase]
+            peak = '-'
+            if result['peak'] is not None:
+                peak = '%.0f' % (result['peak'] / 1024.0)
+            change = ''
+            if baseline is not None and phase in baseline.get(name, {}):
+                before = baseline[name][phase]['best']
+                if before:
+                    change = '%+.1f%%' % (
+                        (result['best'] - before) / before * 100
+                    )
+            out.write('%-14s %-12s %12.2f %12s %12s\n' % (
+                name, phase, result['best'] * 1000, peak, change))
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('--repeat', type=int, default=5,
+                           help="Number of runs of each phase")
+    argparser.add_argument('--save', metavar='FILE',
+                           help="Save the results as JSON")
+    argparser.add_argument('--compare', metavar='FILE',
+                           help="Compare with results saved earlier")
+    args = argparser.parse_args(argv)
+
+    configure()
+    results = run(repeat=args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import threading
+
+try:
+    from collections import OrderedDict
+except:
+    from zope.schema.vocabulary import OrderedDict  # <py27
+
+_marker = object()
+
+
+def fileSignature(path):
+    """Return a (mtime, size, digest) tuple describing the file at path.
+    """
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return st.st_mtime, st.st_size, digest
+
+
+class LRUCache(object):
+    """A mapping of limited size which evicts its least recently used
+    entries first.
+
+    Entries are evicted once more than maxEntries entries are stored, or
+    once the sum of their estimated sizes exceeds maxBytes. Either limit
+    may be None to disable it. All methods may be called from several
+    threads at once.
+    """
+
+    def __init__(self, maxEntries=None, maxBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        return self._entries[key][0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            self.invalidate(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict()
+
+    def invalidate(self, key=_marker):
+        """Drop the entry for key, or all entries if no key is given.
+        """
+        with self._lock:
+            if key is _marker:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        while self._entries and (
+            (self.maxEntries is not None and
+                len(self._entries) > self.maxEntries) or
+            (self.maxBytes is not None and self._bytes > self.maxBytes)
+        ):
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[1]
+            self.evictions += 1
+
+
+class _Flight(object):
+    """A model that is being loaded by one thread and waited for by others.
+    """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.done = threading.Event()
+        self.model = None
+
+
+class ModelCache(LRUCache):
+    """Cache of models parsed from files, keyed by absolute path.
+
+    Every entry remembers the modification time, size and content digest
+    of the file it was parsed from. It is reused for as long as the mtime
+    and size of the file are unchanged or, failing that, as long as the
+    content digest still matches. Entries for files which no longer exist
+    are kept. The size of the file is used as the estimated size of the
+    entry.
+
+    A file is only parsed by one thread at a time. Other threads that need
+    the same model wait for that thread to finish.
+    """
+
+    def __init__(self, maxEntries=None, maxBytes=None):
+        super(ModelCache, self).__init__(maxEntries, maxBytes)
+        self._flights = {}
+
+    def __getitem__(self, path):
+        return self._entries[path][0][0]
+
+    def get(self, path, default=None):
+        model = self.lookup(path)
+        if model is None:
+            return default
+        return model
+
+    def lookup(self, path):
+        """Return the cached model for path if it is still current, or None.
+        """
+        entry = self._entries.get(path, None)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Check the file without holding the lock
+        original = entry
+        model, mtime, size, digest = entry[0]
+        try:
+            st = os.stat(path)
+        except OSError:
+            # The file has gone away. Keep using what we parsed from it.
+            st = None
+
+        current = True
+        if st is not None and st.st_size != size:
+            current = False
+        elif st is not None and st.st_mtime != mtime:
+            if fileSignature(path)[2] != digest:
+                current = False
+            else:
+                # Touched, but not changed
+                entry = ((model, st.st_mtime, size, digest), size)
+
+        with self._lock:
+            stored = self._entries.pop(path, None)
+            if stored is None:
+                # Invalidated in the meantime
+                current = False
+            elif stored is not original:
+                # Replaced in the meantime
+                entry = stored
+                model = stored[0][0]
+                current = True
+            elif not current:
+                self._bytes -= stored[1]
+
+            if current:
+                self._entries[path] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+        if current:
+            return model
+        return None
+
+    def load(self, path, loader):
+        """Return the model for path, calling loader(path) to parse it if
+        there is no current entry in the cache.
+        """
+        while True:
+            model = self.lookup(path)
+            if model is not None:
+                return model
+
+            with self._lock:
+                flight = self._flights.get(path, None)
+                if flight is None:
+                    flight = self._flights[path] = _Flight()
+                    break
+
+            if flight.thread is threading.current_thread():
+                # The file is needed while parsing itself. Let the parser
+                # deal with that, as it did before there was a cache.
+                return loader(path)
+
+            flight.done.wait()
+            if flight.model is not None:
+                return flight.model
+            # The other thread failed. Try again, which will either pick up
+            # a model stored in the meantime or report the error here.
+
+        try:
+            # Take the signature before parsing, so that a file which is
+            # modified while we parse it is picked up again next time.
+            signature = self.signature(path)
+            model = flight.model = loader(path)
+            self.store(path, model, signature)
+            return model
+        finally:
+            with self._lock:
+                del self._flights[path]
+            flight.done.set()
+
+    def signature(self, path):
+        """Return the signature of the file at path, or None if it cannot be
+        read.
+        """
+        try:
+            return fileSignature(path)
+        except (IOError, OSError):
+            return None
+
+    def store(self, path, model, signature):
+        """Store a model parsed from the file at path, given the signature
+        the file had before it was parsed.
+        """
+        if signature is not None:
+            mtime, size, digest = signature
+            self.set(path, (model, mtime, size, digest), size)
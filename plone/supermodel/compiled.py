@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.supermodel import parser
+from plone.supermodel.model import Model
+from plone.supermodel.model import SchemaClass
+from six.moves import cPickle as pickle
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import pkg_resources
+import stat
+import sys
+import tempfile
+
+# Bump this whenever the layout of compiled models changes
+FORMAT_VERSION = 2
+
+
+def _sourceVersion():
+    """Return a version for when the distribution metadata is missing, e.g.
+    in a checkout: the latest modification time of the modules of this
+    package.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    mtimes = [os.path.getmtime(os.path.join(directory, name))
+              for name in os.listdir(directory) if name.endswith('.py')]
+    return 'mtime-%d' % max(mtimes)
+
+
+try:
+    VERSION = pkg_resources.get_distribution('plone.supermodel').version
+except pkg_resources.DistributionNotFound:
+    VERSION = _sourceVersion()
+
+logger = logging.getLogger('plone.supermodel')
+
+_store = None
+
+
+def compileModel(model):
+    """Return a list of records describing the schemata in the model, from
+    which materialize() can construct an equivalent model.
+
+    A record holds everything the parser produced for a schema: the
+    arguments to SchemaClass, the field instances, and the tagged values
+    that were set by the parser and by metadata handlers.
+    """
+    records = []
+    for schemaName, schema in model.schemata.items():
+        fields = [(name, schema[name]) for name in schema.names(all=False)]
+        # Only the schema's own tagged values; those of the bases are
+        # inherited again by the materialized schema
+        getTags = getattr(schema, 'getDirectTaggedValueTags',
+                          schema.getTaggedValueTags)
+        getValue = getattr(schema, 'getDirectTaggedValue',
+                           schema.getTaggedValue)
+        taggedValues = [(tag, getValue(tag)) for tag in getTags()]
+        records.append((
+            schemaName,
+            schema.__name__,
+            schema.__module__,
+            schema.__bases__,
+            fields,
+            taggedValues,
+        ))
+    return records
+
+
+def materialize(records):
+    """Construct a model from records returned by compileModel().
+    """
+    model = Model()
+    for schemaName, name, module, bases, fields, taggedValues in records:
+        schema = SchemaClass(name=name,
+                             bases=bases,
+                             __module__=module,
+                             attrs=dict(fields))
+        for tag, value in taggedValues:
+            schema.setTaggedValue(tag, value)
+        model.schemata[schemaName] = schema
+    return model
+
+
+def dumps(records, schemata=()):
+    """Pickle the given records. References to any of the given schemata
+    (i.e. the interface attribute of their fields) are dropped, since they
+    are reconstructed by materialize().
+    """
+    schemata = set(id(schema) for schema in schemata)
+    f = BytesIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = lambda obj: (
+        'schema' if id(obj) in schemata else None
+    )
+    pickler.dump(records)
+    return f.getvalue()
+
+
+def loads(data):
+    unpickler = pickle.Unpickler(BytesIO(data))
+    unpickler.persistent_load = lambda pid: None
+    return unpickler.load()
+
+
+def _trusted(st, private=False):
+    """Return True if the file or directory with the given stat result may
+    be trusted: it is owned by the current user and is not writable (nor
+    readable, if private is True) by the group or others. Ownership cannot
+    be checked on platforms without os.getuid().
+    """
+    mask = stat.S_IWGRP | stat.S_IWOTH
+    if private:
+        mask |= stat.S_IRGRP | stat.S_IROTH
+    if st.st_mode & mask:
+        return False
+    getuid = getattr(os, 'getuid', None)
+    return getuid is None or st.st_uid == getuid()
+
+
+class CompiledModelStore(object):
+    """Stores compiled models in a directory, one file per model file and
+    policy.
+
+    A compiled model is only used if it was written by the same version of
+    plone.supermodel and Python, for a source file with the same content.
+
+    Since compiled models are pickles, the directory and the files in it
+    must be owned by the current user and must not be writable by anybody
+    else, or they are not used. Every file is authenticated with an HMAC,
+    keyed by a secret stored in the directory, before it is unpickled.
+    """
+
+    keyName = 'hmac.key'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._key = None
+
+    def _filename(self, path, policy):
+        key = u"%s\0%s" % (path, policy)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.pickle')
+
+    def _header(self, path, policy, digest):
+        return (FORMAT_VERSION, VERSION, sys.version_info[:2],
+                path, policy, digest)
+
+    def _checkDirectory(self):
+        if not _trusted(os.stat(self.directory)):
+            raise IOError("Untrusted cache directory %s" % self.directory)
+
+    def _secret(self, create=False):
+        """Return the HMAC key of the directory, creating it if create is
+        True. Raises IOError or OSError if there is no usable key.
+        """
+        if self._key is not None:
+            return self._key
+        filename = os.path.join(self.directory, self.keyName)
+        if create:
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.exists(filename):
+                    raise
+            else:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(os.urandom(32))
+        with open(filename, 'rb') as f:
+            if not _trusted(os.fstat(f.fileno()), private=True):
+                raise IOError("Untrusted key file %s" % filename)
+            key = f.read()
+        if len(key) != 32:
+            raise IOError("Invalid key file %s" % filename)
+        self._key = key
+        return key
+
+    def _mac(self, payload, key):
+        return hmac.new(key, payload, hashlib.sha256).hexdigest().encode(
+            'ascii')
+
+    def load(self, path, policy, digest):
+        """Return the model compiled from the file at path, or None if there
+        is no current compiled model.
+        """
+        filename = self._filename(path, policy)
+        try:
+            self._checkDirectory()
+            key = self._secret()
+            with open(filename, 'rb') as f:
+                if not _trusted(os.fstat(f.fileno())):
+                    raise IOError("Untrusted compiled model %s" % filename)
+                mac = f.readline().rstrip(b'\n')
+                payload = f.read()
+        except (IOError, OSError) as e:
+            logger.debug("Cannot load compiled model %s: %s", filename, e)
+            return None
+
+        if not hmac.compare_digest(mac, self._mac(payload, key)):
+            logger.debug("Invalid signature of compiled model %s", filename)
+            return None
+
+        try:
+            f = BytesIO(payload)
+            if pickle.load(f) != self._header(path, policy, digest):
+                return None
+            records = loads(f.read())
+        except Exception as e:
+            logger.debug("Cannot load compiled model %s: %s", filename, e)
+            return None
+        return materialize(records)
+
+    def save(self, path, policy, digest, model):
+        """Write a compiled model for the file at path. Models which cannot
+        be pickled are skipped.
+        """
+        try:
+            data = dumps(compileModel(model), model.schemata.values())
+        except Exception as e:
+            logger.debug("Cannot compile model %s: %s", path, e)
+            return
+
+        tmpname = None
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory, 0o700)
+                except OSError:
+                    # Another process may have created it in the meantime
+                    if not os.path.isdir(self.directory):
+                        raise
+            self._checkDirectory()
+
+            f = BytesIO()
+            pickle.dump(self._header(path, policy, digest), f, 2)
+            payload = f.getvalue() + data
+            mac = self._mac(payload, self._secret(create=True))
+
+            # Write to a temporary file first, so that concurrent readers
+            # never see a partially written file.
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(mac + b'\n')
+                f.write(payload)
+            os.rename(tmpname, self._filename(path, policy))
+        except (IOError, OSError) as e:
+            logger.debug("Cannot write compiled model %s: %s", path, e)
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+def setCacheDirectory(directory):
+    """Store compiled models in the given directory, or stop using compiled
+    models if directory is None.
+    """
+    global _store
+    if directory:
+        _store = CompiledModelStore(directory)
+    else:
+        _store = None
+
+
+def parseFile(path, policy=u""):
+    """Parse the model file at path, using a compiled model if a cache
+    directory has been configured.
+    """
+    if _store is None:
+        return parser.parse(path, policy=policy)
+
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        # Let the parser report the problem
+        return parser.parse(path, policy=policy)
+
+    model = _store.load(path, policy, digest)
+    if model is None:
+        model = parser.parse(path, policy=policy)
+        _store.save(path, policy, digest, model)
+    return model
+
+
+def compileFile(args):
+    """Parse the model file at path and return it as pickled records, or
+    None if it cannot be parsed or pickled. Called in worker processes by
+    parseFiles().
+    """
+    path, policy = args
+    try:
+        model = parseFile(path, policy=policy)
+        return dumps(compileModel(model), model.schemata.values())
+    except Exception as e:
+        logger.debug("Cannot compile model %s: %s", path, e)
+        return None
+
+
+def parseFiles(paths, policy=u"", workers=None):
+    """Parse the given model files, using a pool of worker processes, and
+    return a list of models in the same order.
+
+    The workers parse the files and send back compiled models, from which
+    the schemata are constructed in this process. Files that cannot be
+    handled by a worker are parsed here, so that errors are reported as
+    usual. The workers are forked where possible, in order to inherit the
+    component registrations of this process.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if workers <= 1 or len(paths) <= 1:
+        return [parseFile(path, policy=policy) for path in paths]
+
+    if hasattr(multiprocessing, 'get_all_start_methods') and \
+            'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+
+    pool = context.Pool(min(workers, len(paths)))
+    try:
+        results = pool.map(compileFile, [(path, policy) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+
+    models = []
+    for path, data in zip(paths, results):
+        if data is None:
+            models.append(parseFile(path, policy=policy))
+        else:
+            models.append(materialize(loads(data)))
+    return models
+
+
+setCacheDirectory(os.environ.get('PLONE_SUPERMODEL_CACHE_DIR'))
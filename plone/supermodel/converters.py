@@ -46,6 +46,12 @@ class DefaultToUnicode(object):
 
 # Date/time fields
 
+# ISO 8601 parsing in the standard library (Python 3.7+), which is much
+# faster than time.strptime()
+_dateFromISO = getattr(datetime.date, 'fromisoformat', None)
+_datetimeFromISO = getattr(datetime.datetime, 'fromisoformat', None)
+
+
 @implementer(IFromUnicode)
 @adapter(IDate)
 class DateFromUnicode(object):
@@ -56,15 +62,36 @@ class DateFromUnicode(object):
         self.context = context
 
     def fromUnicode(self, value):
-        t = time.strptime(value, self.format)
-        d = datetime.date(*t[:3])
+        d = None
+        if _dateFromISO is not None:
+            try:
+                d = _dateFromISO(value)
+            except ValueError:
+                pass
+        if d is None:
+            t = time.strptime(value, self.format)
+            d = datetime.date(*t[:3])
         self.context.validate(d)
         return d
 
 
+@implementer(IToUnicode)
+@adapter(IDate)
+class DateToUnicode(object):
+
+    def __init__(self, context):
+        self.context = context
+
+    def toUnicode(self, value):
+        return text_type(value.isoformat())
+
+
 @implementer(IFromUnicode)
 @adapter(IDatetime)
 class DatetimeFromUnicode(object):
+    """Reads ISO 8601 date/times, including microseconds and a UTC offset
+    where supported, and otherwise the first 19 characters in format.
+    """
 
     format = "%Y-%m-%d %H:%M:%S"
 
@@ -72,12 +99,30 @@ class DatetimeFromUnicode(object):
         self.context = context
 
     def fromUnicode(self, value):
-        t = time.strptime(value[:19], self.format)
-        d = datetime.datetime(*t[:7])
+        d = None
+        if _datetimeFromISO is not None:
+            try:
+                d = _datetimeFromISO(value)
+            except ValueError:
+                pass
+        if d is None:
+            t = time.strptime(value[:19], self.format)
+            d = datetime.datetime(*t[:6])
         self.context.validate(d)
         return d
 
 
+@implementer(IToUnicode)
+@adapter(IDatetime)
+class DatetimeToUnicode(object):
+
+    def __init__(self, context):
+        self.context = context
+
+    def toUnicode(self, value):
+        return text_type(value.isoformat(' '))
+
+
 # Interface fields
 
 @implementer(IFromUnicode)
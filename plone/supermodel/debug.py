@@ -13,3 +13,12 @@ class SupermodelParseInfo(threading.local):
         return self.__dict__[name]
 
 parseinfo = SupermodelParseInfo()
+
+
+class SupermodelSerializeInfo(threading.local):
+
+    # Elements with i18n attributes, in the order in which they were written.
+    # This is a list while a model is being serialized.
+    i18n_nodes = None
+
+serializeinfo = SupermodelSerializeInfo()
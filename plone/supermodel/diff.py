@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Structural differences between models.
+
+The models are compared directly, without serializing them. Schemata and
+fields with equal fingerprints are skipped, and the attributes of other
+fields are compared as described by their field handlers.
+"""
+from plone.supermodel.fingerprint import _canonical
+from plone.supermodel.fingerprint import _fieldAttributes
+from plone.supermodel.fingerprint import fieldFingerprint
+from plone.supermodel.fingerprint import schemaFingerprint
+from plone.supermodel.interfaces import FIELDSETS_KEY
+from plone.supermodel.interfaces import FILENAME_KEY
+from plone.supermodel.registry import fieldTypeName
+from plone.supermodel.registry import getHandlerTable
+from plone.supermodel.utils import sortedFields
+from zope.interface import directlyProvidedBy
+
+# Tagged values that are compared separately, or not at all
+_SKIPPED_TAGS = frozenset([FIELDSETS_KEY, FILENAME_KEY])
+
+# Names reported by diffFields() for private attributes
+_ATTRIBUTE_NAMES = {'_Element__tagged_values': 'taggedValues'}
+
+_missing = object()
+
+
+def _equal(a, b):
+    return a is b or _canonical(a, frozenset()) == _canonical(b, frozenset())
+
+
+def _added(a, b):
+    return [name for name in b if name not in a]
+
+
+def _removed(a, b):
+    return [name for name in a if name not in b]
+
+
+def diffFields(a, b):
+    """Return a sorted list of the names of the attributes that differ
+    between two fields, with 'type' standing for the field type, 'markers'
+    for the marker interfaces they provide and 'taggedValues' for their
+    tagged values. An empty list means that the fields are equivalent.
+    """
+    if fieldFingerprint(a) == fieldFingerprint(b):
+        return []
+
+    fieldType = fieldTypeName(a)
+    if fieldType != fieldTypeName(b):
+        return ['type']
+
+    handler = getHandlerTable().fieldHandler(fieldType)
+    fieldAttributes = getattr(handler, 'fieldAttributes', None)
+    if fieldAttributes is not None:
+        filtered = getattr(handler, 'filteredAttributes', {})
+        names = [name for name in fieldAttributes
+                 if filtered.get(name, '') != 'rw']
+    else:
+        names = set(name for name, value in _fieldAttributes(a))
+        names.update(name for name, value in _fieldAttributes(b))
+
+    changed = [name for name in names
+               if not _equal(getattr(a, name, None), getattr(b, name, None))]
+    if not changed:
+        # Attributes that are not described by the handler
+        attributesA = dict(_fieldAttributes(a))
+        attributesB = dict(_fieldAttributes(b))
+        changed = [_ATTRIBUTE_NAMES.get(name, name)
+                   for name in set(attributesA) | set(attributesB)
+                   if not _equal(attributesA.get(name, _missing),
+                                 attributesB.get(name, _missing))]
+    if list(directlyProvidedBy(a)) != list(directlyProvidedBy(b)):
+        changed.append('markers')
+    return sorted(changed)
+
+
+def _fieldsets(schema):
+    return dict((fieldset.__name__, fieldset)
+                for fieldset in schema.queryTaggedValue(FIELDSETS_KEY, []))
+
+
+def _tags(schema):
+    getTags = getattr(schema, 'getDirectTaggedValueTags',
+                      schema.getTaggedValueTags)
+    getValue = getattr(schema, 'getDirectTaggedValue', schema.getTaggedValue)
+    return dict((tag, getValue(tag)) for tag in getTags()
+                if tag not in _SKIPPED_TAGS)
+
+
+def diffSchemata(a, b):
+    """Return a dict describing the differences between two schemata, or
+    an empty dict if they are equivalent. The dict has these keys:
+
+    fields
+        A dict with lists of 'added' and 'removed' field names and a dict
+        of 'changed' fields, mapping their names to the list returned by
+        diffFields().
+    fieldsets
+        A dict with lists of 'added', 'removed' and 'changed' fieldset
+        names. A fieldset has changed if its label, description or fields
+        have.
+    order
+        True if the fields both schemata have are in a different order.
+    metadata
+        The sorted tags of the other tagged values that differ, e.g. those
+        holding invariants or the metadata read by metadata handlers.
+    bases
+        True if the bases differ.
+    """
+    if schemaFingerprint(a) == schemaFingerprint(b):
+        return {}
+
+    fieldsA = dict(sortedFields(a))
+    fieldsB = dict(sortedFields(b))
+    fields = {
+        'added': [name for name, field in sortedFields(b)
+                  if name not in fieldsA],
+        'removed': [name for name, field in sortedFields(a)
+                    if name not in fieldsB],
+        'changed': {},
+    }
+    order = [name for name, field in sortedFields(a) if name in fieldsB] != \
+        [name for name, field in sortedFields(b) if name in fieldsA]
+    for name, field in fieldsA.items():
+        if name in fieldsB:
+            changed = diffFields(field, fieldsB[name])
+            if changed:
+                fields['changed'][name] = changed
+
+    fieldsetsA = _fieldsets(a)
+    fieldsetsB = _fieldsets(b)
+    fieldsets = {
+        'added': sorted(_added(fieldsetsA, fieldsetsB)),
+        'removed': sorted(_removed(fieldsetsA, fieldsetsB)),
+        'changed': sorted(
+            name for name, fieldset in fieldsetsA.items()
+            if name in fieldsetsB and not (
+                fieldset.label == fieldsetsB[name].label and
+                fieldset.description == fieldsetsB[name].description and
+                list(fieldset.fields) == list(fieldsetsB[name].fields)
+            )
+        ),
+    }
+
+    tagsA = _tags(a)
+    tagsB = _tags(b)
+    metadata = sorted(
+        set(_added(tagsA, tagsB)) | set(_removed(tagsA, tagsB)) |
+        set(tag for tag in tagsA if tag in tagsB and
+            not _equal(tagsA[tag], tagsB[tag]))
+    )
+
+    bases = [base.__identifier__ for base in a.__bases__] != \
+        [base.__identifier__ for base in b.__bases__]
+
+    return {
+        'fields': fields,
+        'fieldsets': fieldsets,
+        'order': order,
+        'metadata': metadata,
+        'bases': bases,
+    }
+
+
+def diffModels(a, b):
+    """Return a dict describing the differences between two models, with
+    sorted lists of 'added' and 'removed' schema names and a dict of
+    'changed' schemata, mapping their names to the dict returned by
+    diffSchemata(). If the models are equivalent, all of them are empty.
+    """
+    changed = {}
+    for name, schema in a.schemata.items():
+        if name in b.schemata:
+            schemaDiff = diffSchemata(schema, b.schemata[name])
+            if schemaDiff:
+                changed[name] = schemaDiff
+
+    return {
+        'added': sorted(_added(a.schemata, b.schemata)),
+        'removed': sorted(_removed(a.schemata, b.schemata)),
+        'changed': changed,
+    }
+
+
+__all__ = ('diffModels', 'diffSchemata', 'diffFields', )
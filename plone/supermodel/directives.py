@@ -61,11 +61,23 @@ class MetadataDictDirective(Directive):
 
 # Plugin
 
+class _KeyTaggedValues(object):
+    """The taggedValues of a checker plugin: just its key. Subclasses which
+    need to run for other schemata too can set taggedValues to None.
+    """
+
+    def __get__(self, instance, cls):
+        if cls.key is None:
+            return None
+        return (cls.key, )
+
+
 @adapter(ISchema)
 @implementer(ISchemaPlugin)
 class CheckerPlugin(object):
 
     key = None
+    taggedValues = _KeyTaggedValues()
 
     def __init__(self, schema):
         self.schema = schema
@@ -136,6 +148,7 @@ class load(Directive):
 class SupermodelSchemaPlugin(object):
 
     order = -1000
+    taggedValues = (FILENAME_KEY, )
 
     def __init__(self, interface):
         self.interface = interface
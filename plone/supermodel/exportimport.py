@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 from lxml import etree
 from plone.supermodel.debug import parseinfo
+from plone.supermodel.debug import serializeinfo
 from plone.supermodel.interfaces import IDefaultFactory
 from plone.supermodel.interfaces import IFieldExportImportHandler
-from plone.supermodel.interfaces import IFieldNameExtractor
+from plone.supermodel.interfaces import IFieldNameExtractor  # BBB
+from plone.supermodel.interfaces import I18N_NAMESPACE
+from plone.supermodel.interfaces import XML_NAMESPACE
+from plone.supermodel.jsonml import fromJsonML
+from plone.supermodel.jsonml import toJsonML
+from plone.supermodel.registry import fieldTypeName
+from plone.supermodel.registry import getHandlerTable
+from plone.supermodel.utils import jsonToValue
 from plone.supermodel.utils import noNS
+from plone.supermodel.utils import recordI18nNodes
+from plone.supermodel.utils import recordsI18n
 from plone.supermodel.utils import valueToElement
+from plone.supermodel.utils import valueToJSON
 from plone.supermodel.utils import elementToValue
-from zope.component import queryUtility
 from zope.interface import Interface
 from zope.interface import implementedBy
 from zope.interface import implementer
@@ -30,10 +40,116 @@ else:
     text_type = unicode
 
 
+# What BaseHandler.read() does with the child elements of a field
+_SKIP = 'skip'
+_READ = 'read'
+_DEFERRED = 'deferred'
+_DEFERRED_NONVALIDATED = 'deferred_nonvalidated'
+_NESTED = 'nested'
+
+
+def _noValidation(value):
+    return True
+
+
 class OrderedDictField(zope.schema.Dict):
     _type = OrderedDict
 
 
+# Keys of the JSON object of a field that are not field attributes
+_JSON_KEYS = frozenset(['name', 'type', 'metadata', 'element'])
+
+# Methods of field handlers and their JSON counterparts
+_JSON_METHODS = (
+    ('read', 'readJSON'),
+    ('write', 'writeJSON'),
+    ('readAttribute', 'readAttributeJSON'),
+    ('writeAttribute', 'writeAttributeJSON'),
+)
+
+_jsonClasses = {}
+
+
+def supportsJSON(handler):
+    """Return True if the given field handler reads and writes fields as
+    JSON objects with readJSON() and writeJSON(). This is the case if the
+    JSON counterparts of its read(), write(), readAttribute() and
+    writeAttribute() methods are not overridden by the XML methods in a
+    subclass.
+    """
+    cls = handler.__class__
+    try:
+        return _jsonClasses[cls]
+    except KeyError:
+        pass
+    result = True
+    for method, json_method in _JSON_METHODS:
+        for klass in cls.__mro__:
+            if json_method in klass.__dict__:
+                break
+            if method in klass.__dict__:
+                result = False
+                break
+        else:
+            result = False
+    _jsonClasses[cls] = result
+    return result
+
+
+def jsonNamespaces():
+    """Return the namespace prefixes used for the elements written by
+    metadata handlers and by field handlers which do not supportsJSON(),
+    by namespace URI.
+    """
+    handlers = getHandlerTable()
+    prefixes = {I18N_NAMESPACE: 'i18n'}
+    for name, handler in handlers.schemaMetadataHandlers + \
+            handlers.fieldMetadataHandlers:
+        if handler.namespace is not None and handler.prefix is not None:
+            prefixes[handler.namespace] = handler.prefix
+    return prefixes
+
+
+def fieldToJSON(handler, field, name, type):
+    """Return the JSON object representing the given field, written by its
+    handler. For handlers which do not supportsJSON(), this holds the JsonML
+    of the field element in 'element'.
+    """
+    if supportsJSON(handler):
+        return handler.writeJSON(field, name, type)
+
+    start = len(serializeinfo.i18n_nodes or ())
+    element = handler.write(field, name, type)
+    if element is None:
+        return None
+    if not recordsI18n(handler):
+        recordI18nNodes(element, start)
+
+    data = OrderedDict()
+    if name:
+        data['name'] = name
+    data['type'] = type
+    data['element'] = toJsonML(element, prefixes=jsonNamespaces())
+    return data
+
+
+def fieldFromJSON(handler, data):
+    """Read a field from a JSON object returned by fieldToJSON() with its
+    handler, and return a new instance.
+    """
+    if 'element' in data:
+        namespaces = dict((prefix, uri) for uri, prefix
+                          in jsonNamespaces().items())
+        namespaces[None] = XML_NAMESPACE
+        return handler.read(fromJsonML(data['element'], namespaces).getroot())
+    if not supportsJSON(handler):
+        raise ValueError(
+            u"Fields of type %s can only be read from an 'element'" %
+            data.get('type')
+        )
+    return handler.readJSON(data)
+
+
 @implementer(IFieldExportImportHandler)
 class BaseHandler(object):
     """Base class for import/export handlers.
@@ -49,6 +165,10 @@ class BaseHandler(object):
 
     filteredAttributes = {'order': 'rw', 'unique': 'rw', 'defaultFactory': 'w'}
 
+    # write() only writes i18n attributes with valueToElement(); see
+    # utils.recordsI18n()
+    i18nRecorded = True
+
     # Elements that are of the same type as the field itself
     fieldTypeAttributes = ('min', 'max', 'default', )
 
@@ -63,6 +183,12 @@ class BaseHandler(object):
 
     forcedFields = frozenset(['default', 'missing_value'])
 
+    # Tag -> read action, see _readAction()
+    _readActions = None
+
+    # Attribute fields to write, see _writeAttributes()
+    _writePlan = None
+
     def __init__(self, klass):
         self.klass = klass
         self.fieldAttributes = {}
@@ -82,6 +208,37 @@ class BaseHandler(object):
     def _constructField(self, attributes):
         return self.klass(**attributes)
 
+    def _readAction(self, tag):
+        """Return an (action, attribute name, attribute field) tuple telling
+        read() what to do with a child element with the given tag. The
+        result is computed once per tag and handler.
+        """
+        actions = self._readActions
+        if actions is None:
+            # Built on first use, after subclasses have set up their
+            # attributes
+            actions = self._readActions = {}
+        try:
+            return actions[tag]
+        except KeyError:
+            pass
+
+        attribute_name = noNS(tag)
+        attributeField = self.fieldAttributes.get(attribute_name, None)
+        if 'r' in self.filteredAttributes.get(attribute_name, '') or \
+                attributeField is None:
+            action = _SKIP
+        elif attribute_name in self.fieldTypeAttributes:
+            action = _DEFERRED
+        elif attribute_name in self.nonValidatedfieldTypeAttributes:
+            action = _DEFERRED_NONVALIDATED
+        elif attribute_name in self.fieldInstanceAttributes:
+            action = _NESTED
+        else:
+            action = _READ
+        actions[tag] = result = (action, attribute_name, attributeField)
+        return result
+
     def read(self, element):
         """Read a field from the element and return a new instance
         """
@@ -90,44 +247,41 @@ class BaseHandler(object):
         deferred_nonvalidated = {}
 
         for attribute_element in element.iterchildren(tag=etree.Element):
-            parseinfo.stack.append(attribute_element)
-            attribute_name = noNS(attribute_element.tag)
-
-            if 'r' in self.filteredAttributes.get(attribute_name, ''):
+            action, attribute_name, attributeField = self._readAction(
+                attribute_element.tag
+            )
+            if action is _SKIP:
                 continue
+            parseinfo.stack.append(attribute_element)
 
-            attributeField = self.fieldAttributes.get(attribute_name, None)
-            if attributeField is not None:
+            if action is _READ:
+                attributes[attribute_name] = self.readAttribute(
+                    attribute_element,
+                    attributeField
+                )
 
-                if attribute_name in self.fieldTypeAttributes:
-                    deferred[attribute_name] = attribute_element
+            elif action is _DEFERRED:
+                deferred[attribute_name] = attribute_element
 
-                elif attribute_name in self.nonValidatedfieldTypeAttributes:
-                    deferred_nonvalidated[attribute_name] = attribute_element
+            elif action is _DEFERRED_NONVALIDATED:
+                deferred_nonvalidated[attribute_name] = attribute_element
 
-                elif attribute_name in self.fieldInstanceAttributes:
+            else:
+                attributeField_type = attribute_element.get('type')
+                handler = getHandlerTable().fieldHandler(
+                    attributeField_type
+                )
 
-                    attributeField_type = attribute_element.get('type')
-                    handler = queryUtility(
-                        IFieldExportImportHandler,
-                        name=attributeField_type
+                if handler is None:
+                    raise NotImplementedError(
+                        u"Type %s used for %s not supported" %
+                        (attributeField_type, attribute_name)
                     )
 
-                    if handler is None:
-                        raise NotImplementedError(
-                            u"Type %s used for %s not supported" %
-                            (attributeField_type, attribute_name)
-                        )
-
-                    attributes[attribute_name] = handler.read(
-                        attribute_element
-                    )
+                attributes[attribute_name] = handler.read(
+                    attribute_element
+                )
 
-                else:
-                    attributes[attribute_name] = self.readAttribute(
-                        attribute_element,
-                        attributeField
-                    )
             parseinfo.stack.pop()
 
         name = element.get('name')
@@ -135,6 +289,71 @@ class BaseHandler(object):
             name = str(name)
             attributes['__name__'] = name
 
+        def readDeferred(attribute_element, field_instance):
+            parseinfo.stack.append(attribute_element)
+            value = self.readAttribute(attribute_element, field_instance)
+            parseinfo.stack.pop()
+            return value
+
+        return self._finishField(attributes, deferred, deferred_nonvalidated,
+                                 readDeferred)
+
+    def readJSON(self, data):
+        """Read a field from a JSON object, as returned by writeJSON(), and
+        return a new instance. The attributes of the field are read directly
+        from the object's values.
+        """
+        attributes = {}
+        deferred = {}
+        deferred_nonvalidated = {}
+
+        for attribute_name, value in data.items():
+            if attribute_name in _JSON_KEYS:
+                continue
+            action, attribute_name, attributeField = self._readAction(
+                attribute_name
+            )
+            if action is _SKIP:
+                continue
+
+            if action is _READ:
+                attributes[attribute_name] = self.readAttributeJSON(
+                    value,
+                    attributeField
+                )
+
+            elif action is _DEFERRED:
+                deferred[attribute_name] = value
+
+            elif action is _DEFERRED_NONVALIDATED:
+                deferred_nonvalidated[attribute_name] = value
+
+            else:
+                attributeField_type = value.get('type')
+                handler = getHandlerTable().fieldHandler(
+                    attributeField_type
+                )
+
+                if handler is None:
+                    raise NotImplementedError(
+                        u"Type %s used for %s not supported" %
+                        (attributeField_type, attribute_name)
+                    )
+
+                attributes[attribute_name] = fieldFromJSON(handler, value)
+
+        name = data.get('name')
+        if name is not None:
+            attributes['__name__'] = str(name)
+
+        return self._finishField(attributes, deferred, deferred_nonvalidated,
+                                 self.readAttributeJSON)
+
+    def _finishField(self, attributes, deferred, deferred_nonvalidated,
+                     readDeferred):
+        """Construct the field from the given attributes, then set the
+        deferred attributes read with readDeferred(value, field_instance).
+        """
         field_instance = self._constructField(attributes)
 
         # some fields can't validate fully until they're finished setting up
@@ -144,28 +363,27 @@ class BaseHandler(object):
         # constructed, in the preferred order.
         for attribute_name in self.fieldTypeAttributes:
             if attribute_name in deferred:
-                attribute_element = deferred[attribute_name]
-                parseinfo.stack.append(attribute_element)
-                value = self.readAttribute(attribute_element, field_instance)
+                value = readDeferred(deferred[attribute_name], field_instance)
                 setattr(field_instance, attribute_name, value)
-                parseinfo.stack.pop()
 
         for attribute_name in self.nonValidatedfieldTypeAttributes:
             if attribute_name in deferred_nonvalidated:
 
                 # this is pretty nasty: we need the field's fromUnicode(),
                 # but this always validates. The missing_value field may by
-                # definition be invalid. Therefore, we need to fake it.
-
-                clone = self.klass.__new__(self.klass)
-                clone.__dict__.update(field_instance.__dict__)
-                clone.__dict__['validate'] = lambda value: True
-
-                attribute_element = deferred_nonvalidated[attribute_name]
-                parseinfo.stack.append(attribute_element)
-                value = self.readAttribute(attribute_element, clone)
+                # definition be invalid. Therefore, we need to fake it, by
+                # shadowing validate() on the new field while the value is
+                # read.
+
+                field_instance.__dict__['validate'] = _noValidation
+                try:
+                    value = readDeferred(
+                        deferred_nonvalidated[attribute_name],
+                        field_instance
+                    )
+                finally:
+                    del field_instance.__dict__['validate']
                 setattr(field_instance, attribute_name, value)
-                parseinfo.stack.pop()
 
         field_instance._init_field = True
 
@@ -199,16 +417,44 @@ class BaseHandler(object):
 
         element.set('type', type)
 
-        for attribute_name in sorted(self.fieldAttributes.keys()):
-            attributeField = self.fieldAttributes[attribute_name]
-            if 'w' in self.filteredAttributes.get(attribute_name, ''):
-                continue
+        for attributeField in self._writeAttributes():
             child = self.writeAttribute(attributeField, field)
             if child is not None:
                 element.append(child)
 
         return element
 
+    def writeJSON(self, field, name, type):
+        """Return a JSON object representing the given field, with the
+        attributes that write() writes.
+        """
+        data = OrderedDict()
+        if name:
+            data['name'] = name
+        data['type'] = type
+
+        for attributeField in self._writeAttributes():
+            item = self.writeAttributeJSON(attributeField, field)
+            if item is not None:
+                data[item[0]] = item[1]
+
+        return data
+
+    def _writeAttributes(self):
+        """Return the attribute fields that write() writes, in order. The
+        list is computed once per handler.
+        """
+        attributes = self._writePlan
+        if attributes is None:
+            # Built on first use, after subclasses have set up their
+            # attributes
+            attributes = self._writePlan = tuple([
+                self.fieldAttributes[attribute_name]
+                for attribute_name in sorted(self.fieldAttributes.keys())
+                if 'w' not in self.filteredAttributes.get(attribute_name, '')
+            ])
+        return attributes
+
     # Field attribute read and write
 
     def readAttribute(self, element, attributeField):
@@ -217,13 +463,22 @@ class BaseHandler(object):
         """
         return elementToValue(attributeField, element)
 
+    def readAttributeJSON(self, value, attributeField):
+        """Read a single attribute from the given JSON value, as for
+        readAttribute().
+        """
+        return jsonToValue(attributeField, value)
+
     def writeAttribute(self, attributeField, field, ignoreDefault=True):
         """Create and return a element that describes the given attribute
         field on the given field
         """
 
         elementName = attributeField.__name__
-        attributeField = attributeField.bind(field)
+        if attributeField.defaultFactory is not None:
+            # Only a default factory can make the default depend on the
+            # field
+            attributeField = attributeField.bind(field)
         value = attributeField.get(field)
 
         force = (elementName in self.forcedFields)
@@ -233,18 +488,19 @@ class BaseHandler(object):
 
         # The value points to another field. Recurse.
         if IField.providedBy(value):
-            value_fieldType = IFieldNameExtractor(value)()
-            handler = queryUtility(
-                IFieldExportImportHandler,
-                name=value_fieldType
-            )
+            value_fieldType = fieldTypeName(value)
+            handler = getHandlerTable().fieldHandler(value_fieldType)
             if handler is None:
                 return None
-            return handler.write(
+            start = len(serializeinfo.i18n_nodes or ())
+            child = handler.write(
                 value, name=None,
                 type=value_fieldType,
                 elementName=elementName
             )
+            if child is not None and not recordsI18n(handler):
+                recordI18nNodes(child, start)
+            return child
 
         # For 'default', 'missing_value' etc, we want to validate against
         # the imported field type itself, not the field type of the attribute
@@ -262,6 +518,42 @@ class BaseHandler(object):
             force=force
         )
 
+    def writeAttributeJSON(self, attributeField, field, ignoreDefault=True):
+        """Return a (name, JSON value) pair for the given attribute field on
+        the given field, or None if it is not written, as for
+        writeAttribute().
+        """
+        name = attributeField.__name__
+        if attributeField.defaultFactory is not None:
+            attributeField = attributeField.bind(field)
+        value = attributeField.get(field)
+
+        if ignoreDefault and value == attributeField.default:
+            return None
+
+        if IField.providedBy(value):
+            value_fieldType = fieldTypeName(value)
+            handler = getHandlerTable().fieldHandler(value_fieldType)
+            if handler is None:
+                return None
+            data = fieldToJSON(handler, value, None, value_fieldType)
+            if data is None:
+                return None
+            return name, data
+
+        if name in self.fieldTypeAttributes or \
+                name in self.nonValidatedfieldTypeAttributes:
+            attributeField = field
+
+        if isinstance(value, bytes) and not isinstance(value, str):
+            value = value.decode('utf-8')
+
+        return name, valueToJSON(
+            attributeField,
+            value,
+            force=(name in self.forcedFields)
+        )
+
 
 class DictHandler(BaseHandler):
     """Special handling for the Dict field, which uses Attribute instead of
@@ -349,6 +641,14 @@ class ChoiceHandler(BaseHandler):
                     )
         return elementToValue(attributeField, element)
 
+    def readAttributeJSON(self, value, attributeField):
+        if attributeField.__name__ == 'values' and isinstance(value, dict):
+            attributeField = OrderedDictField(
+                key_type=zope.schema.TextLine(),
+                value_type=zope.schema.TextLine(),
+                )
+        return jsonToValue(attributeField, value)
+
     def _constructField(self, attributes):
         if 'values' in attributes:
             if isinstance(attributes['values'], OrderedDict):
@@ -373,22 +673,39 @@ class ChoiceHandler(BaseHandler):
             del attributes['values']
         return super(ChoiceHandler, self)._constructField(attributes)
 
+    i18nRecorded = True
+
     def write(self, field, name, type, elementName='field'):
 
         element = super(ChoiceHandler, self).write(field, name, type, elementName)
 
         # write vocabulary or values list
+        attribute_name, attributeField, value = self._vocabulary(field)
+        child = valueToElement(
+            attributeField,
+            value,
+            name=attribute_name,
+            force=True
+        )
+        element.append(child)
+
+        return element
+
+    def writeJSON(self, field, name, type):
+        data = super(ChoiceHandler, self).writeJSON(field, name, type)
+        attribute_name, attributeField, value = self._vocabulary(field)
+        data[attribute_name] = valueToJSON(attributeField, value, force=True)
+        return data
+
+    def _vocabulary(self, field):
+        """Return the name, attribute field and value of the attribute that
+        describes the vocabulary of the given field.
+        """
 
         # Named vocabulary
         if field.vocabularyName is not None and field.vocabulary is None:
-            attributeField = self.fieldAttributes['vocabulary']
-            child = valueToElement(
-                attributeField,
-                field.vocabularyName,
-                name='vocabulary',
-                force=True
-            )
-            element.append(child)
+            return ('vocabulary', self.fieldAttributes['vocabulary'],
+                    field.vocabularyName)
 
         # Listed vocabulary - attempt to convert to a simple list of values
         elif field.vocabularyName is None \
@@ -415,13 +732,7 @@ class ChoiceHandler(BaseHandler):
                     key_type=zope.schema.TextLine(),
                     value_type=zope.schema.TextLine(),
                     )
-            child = valueToElement(
-                attributeField,
-                value,
-                name='values',
-                force=True
-            )
-            element.append(child)
+            return 'values', attributeField, value
 
         # Anything else is not allowed - we can't export ISource/IVocabulary or
         #  IContextSourceBinder objects.
@@ -431,5 +742,3 @@ class ChoiceHandler(BaseHandler):
                 u"a simple list of values or a named vocabulary "
                 u"cannot be exported"
             )
-
-        return element
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Structural fingerprints of fields, schemata and models.
+
+A fingerprint is a hex digest that only depends on the structure of the
+object: two schemata parsed from equivalent XML have the same fingerprint,
+whatever their names, modules and the files they were read from.
+Fingerprints are cached on fields and schemata. Changes made in place to
+mutable attribute or tagged values (e.g. appending to a list) are not
+noticed.
+"""
+from plone.supermodel.interfaces import FILENAME_KEY
+from plone.supermodel.model import SchemaClass
+from plone.supermodel.model import taggedValuesGeneration
+from plone.supermodel.utils import sortedFields
+from zope.i18nmessageid import Message
+from zope.interface import directlyProvidedBy
+from zope.interface.interface import InterfaceClass
+from zope.schema.interfaces import IField
+from zope.schema.interfaces import IVocabularyTokenized
+import hashlib
+import inspect
+import six
+
+# Tagged values that do not describe the structure of a schema
+IGNORED_TAGS = frozenset([FILENAME_KEY])
+
+# Field attributes that differ between equivalent fields
+IGNORED_ATTRIBUTES = frozenset(['interface', 'order', '__provides__'])
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def _dotted(obj):
+    return '%s.%s' % (getattr(obj, '__module__', None),
+                      getattr(obj, '__name__', obj.__class__.__name__))
+
+
+def _fieldAttributes(field):
+    return sorted(((name, value) for name, value in field.__dict__.items()
+                   if name not in IGNORED_ATTRIBUTES and
+                   not name.startswith('_v_')),
+                  key=lambda item: item[0])
+
+
+def _canonical(value, seen):
+    """Return a representation of value made of tuples and builtin types,
+    which can be hashed by repr().
+    """
+    if value is None or isinstance(value, (bool, float) + six.integer_types):
+        return value
+    if isinstance(value, Message):
+        return ('message', six.text_type(value), value.domain,
+                value.default, _canonical(value.mapping, seen))
+    if isinstance(value, (six.text_type, bytes)):
+        return value
+    if IField.providedBy(value):
+        return ('field', fieldFingerprint(value))
+    if isinstance(value, InterfaceClass):
+        return ('interface', value.__identifier__)
+    if isinstance(value, (list, tuple)):
+        return (value.__class__.__name__,
+                tuple([_canonical(item, seen) for item in value]))
+    if isinstance(value, (set, frozenset)):
+        return ('set', tuple(sorted(repr(_canonical(item, seen))
+                                    for item in value)))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            (repr(_canonical(k, seen)), _canonical(v, seen))
+            for k, v in value.items()
+        )))
+    if inspect.isclass(value) or inspect.isroutine(value):
+        # Classes and functions, e.g. invariants and default factories
+        return ('object', _dotted(value))
+
+    # Other objects, e.g. vocabularies and fieldsets
+    if id(value) in seen:
+        return ('cycle', _dotted(value.__class__))
+    seen = seen | set([id(value)])
+    if IVocabularyTokenized.providedBy(value):
+        return ('vocabulary', _dotted(value.__class__), tuple([
+            (_canonical(term.value, seen), term.token,
+             _canonical(getattr(term, 'title', None), seen))
+            for term in value
+        ]))
+    if hasattr(value, '__dict__'):
+        return ('instance', _dotted(value.__class__),
+                _canonical(value.__dict__, seen))
+    return ('repr', repr(value))
+
+
+def _same(a, b):
+    return len(a) == len(b) and all(
+        x[0] == y[0] and x[1] is y[1] for x, y in zip(a, b)
+    )
+
+
+def fieldFingerprint(field):
+    """Return the fingerprint of a field, based on its class, marker
+    interfaces, tagged values and other attributes (apart from its
+    interface and order).
+
+    The result is cached on the field until one of its attributes or
+    tagged values is set to a different object, or its marker interfaces
+    change.
+    """
+    attributes = _fieldAttributes(field)
+    provides = field.__dict__.get('__provides__')
+    tagged = tuple(
+        (field.__dict__.get('_Element__tagged_values') or {}).items()
+    )
+    cached = field.__dict__.get('_v_supermodel_fingerprint')
+    if cached is not None and cached[1] is provides and \
+            _same(cached[0], attributes) and _same(cached[2], tagged):
+        return cached[3]
+
+    digest = _digest((
+        _dotted(field.__class__),
+        tuple(sorted(iface.__identifier__
+                     for iface in directlyProvidedBy(field))),
+        tuple([(name, _canonical(value, frozenset()))
+               for name, value in attributes]),
+    ))
+    field._v_supermodel_fingerprint = (attributes, provides, tagged, digest)
+    return digest
+
+
+def _schemaFingerprint(schema, fields):
+    # Only the schema's own tagged values; those of the bases are covered
+    # by their identifiers
+    getTags = getattr(schema, 'getDirectTaggedValueTags',
+                      schema.getTaggedValueTags)
+    getValue = getattr(schema, 'getDirectTaggedValue', schema.getTaggedValue)
+    taggedValues = []
+    for tag in sorted(getTags()):
+        if tag in IGNORED_TAGS:
+            continue
+        taggedValues.append((tag, _canonical(getValue(tag), frozenset())))
+    return _digest((
+        tuple([base.__identifier__ for base in schema.__bases__]),
+        fields,
+        tuple(taggedValues),
+    ))
+
+
+def schemaFingerprint(schema):
+    """Return the fingerprint of a schema, based on its bases, its own
+    fields in order and its tagged values, which hold its fieldsets,
+    invariants and the metadata read by metadata handlers. The name and
+    module of the schema are not included.
+
+    For instances of SchemaClass, the result is cached until a tagged
+    value is set, the bases or fields change, or the fingerprint of one of
+    the fields changes.
+    """
+    fields = tuple([(name, fieldFingerprint(field))
+                    for name, field in sortedFields(schema)])
+    if not isinstance(schema, SchemaClass):
+        return _schemaFingerprint(schema, fields)
+
+    key = (taggedValuesGeneration(schema), schema.__bases__, fields)
+    cached = schema.__dict__.get('_v_supermodel_fingerprint')
+    if cached is not None and cached[0][0] == key[0] and \
+            cached[0][1] is key[1] and cached[0][2] == key[2]:
+        return cached[1]
+
+    digest = _schemaFingerprint(schema, fields)
+    schema._v_supermodel_fingerprint = (key, digest)
+    return digest
+
+
+def modelFingerprint(model):
+    """Return the fingerprint of a model, based on the names and
+    fingerprints of its schemata.
+    """
+    return _digest(tuple(sorted(
+        (name, schemaFingerprint(schema))
+        for name, schema in model.schemata.items()
+    )))
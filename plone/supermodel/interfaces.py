@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import pkg_resources
+from zope.interface import Attribute
 from zope.interface import Interface
 from zope.interface.interfaces import IInterface
 import zope.schema
@@ -95,6 +96,12 @@ class ISchemaPlugin(Interface):
     order = zope.schema.Int(title=u"Order", required=False,
                             description=u"Sort key for plugin execution order")
 
+    taggedValues = Attribute(
+        u"Optional tags of the tagged values the plugin works on, set on "
+        u"the adapter factory. The plugin is not created for schemata "
+        u"which have none of these tagged values."
+    )
+
     def __call__():
         """Execute plugin
         """
@@ -113,7 +120,7 @@ class IXMLToSchema(Interface):
         model = loadFile('schema.xml')
     """
 
-    def xmlSchema(filename, schema=u"", policy=u""):
+    def xmlSchema(filename, schema=u"", policy=u"", lazy=False):
         """Given a filename relative to the current module, return an
         interface representing the schema contained in that file. If there
         are multiple <schema /> blocks, return the unnamed one, unless
@@ -124,32 +131,80 @@ class IXMLToSchema(Interface):
         Policies must be registered as named utilities providing
         ISchemaPolicy.
 
+        If lazy is True, only the requested schema is constructed (see
+        loadFile()).
+
         Raises a KeyError if the schema cannot be found.
         Raises an IOError if the file cannot be opened.
         """
 
-    def loadFile(filename, reload=False, policy=u""):
+    def loadFile(filename, reload=False, policy=u"", lazy=False):
         """Return an IModel as contained in the given XML file, which is read
         relative to the current module (unless it is an absolute path).
 
-        If reload is True, reload a schema even if it's cached. If policy
+        If reload is True, reload a schema even if it's cached. Cached
+        models are also reloaded when the file has changed on disk. If policy
         is given, it can be used to select a custom schema parsing policy.
         Policies must be registered as named utilities providing
         ISchemaPolicy.
+
+        If lazy is True and the file is not cached yet, each schema in the
+        model is only constructed when it is first looked up in the
+        model's schemata mapping.
+        """
+
+    def loadFiles(filenames, policy=u"", workers=None):
+        """Return a list of IModels for the given files, in the same way as
+        loadFile() would, using up to the given number of worker processes
+        to parse files that are not cached. By default, one worker per CPU
+        is used.
+        """
+
+    def invalidateFile(filename=None):
+        """Drop the cached model for the given file, which is found in the
+        same way as for loadFile(), so that it is parsed again on next use.
+        If no filename is given, the whole cache is cleared.
         """
 
-    def loadString(model, policy=u""):
+    def loadString(model, policy=u"", cached=False):
         """Load a model from a string rather than a file.
+
+        If cached is True, a model parsed earlier from the same string with
+        the same policy is reused. The returned model then shares its
+        schema interfaces with other callers, and they must not be modified.
         """
 
-    def serializeSchema(schema, name=u""):
+    def serializeSchema(schema, name=u"", mode='compat'):
         """Return an XML string representing the given schema interface. This
         is a convenience method around the serializeModel() method, below.
         """
 
-    def serializeModel(model):
+    def serializeModel(model, mode='compat'):
         """Return an XML string representing the given model, as returned by
         the loadFile() or loadString() method.
+
+        The mode selects how the XML is formatted: 'compat' indents it in
+        the same way as earlier versions did, 'pretty' lets lxml indent it,
+        and 'compact' does not indent it at all, which is fastest.
+        """
+
+    def loadJSON(data, policy=u""):
+        """Load a model from its JSON representation, as returned by the
+        serializeModelJSON() method. data may be a JSON string or the
+        decoded object.
+
+        Fields are constructed directly from their JSON objects, without
+        building an element tree, so this is faster than loadString().
+        """
+
+    def serializeModelJSON(model):
+        """Return a JSON string representing the given model. Its
+        'schemata' object holds an object for each schema by name, with
+        the 'fields' and 'fieldsets' of the schema. Each field is an object
+        with its 'name', 'type' and attributes, in the same text form as in
+        XML; nested fields are objects, collections are lists and dicts are
+        objects. What metadata handlers write is kept as JsonML in
+        'metadata'.
         """
 
 
@@ -186,6 +241,11 @@ class IFieldExportImportHandler(Interface):
         """Create and return a new node representing the given field
         """
 
+    # Handlers may also implement readJSON(data) and
+    # writeJSON(field, fieldName, fieldType) to read and write fields as
+    # JSON objects, as BaseHandler does. Fields of other handlers are
+    # written to JSON as the JsonML of their node.
+
 
 class ISchemaMetadataHandler(Interface):
     """A third party application can register named utilities providing this
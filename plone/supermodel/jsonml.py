@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Conversion between element trees and JsonML, a JSON representation of
+XML elements.
+
+An element is written as a list holding the tag, an optional object with
+the attributes, and the child elements and text, e.g.::
+
+    ["field", {"name": "title", "type": "zope.schema.TextLine"},
+        ["title", "Title"]]
+
+Tags and attributes in other namespaces than the default one use the
+prefixes declared with "xmlns:prefix" attributes on the root element, as in
+XML, or known prefixes.
+
+JSON models hold fields and their attributes as plain objects. JsonML is
+only used there for what metadata handlers, and field handlers without JSON
+support, write as elements.
+"""
+from lxml import etree
+import six
+
+XMLNS = u'xmlns'
+
+
+def _qname(name, prefixes):
+    """Return the prefixed name for an element or attribute name in Clark
+    notation.
+    """
+    if not name.startswith('{'):
+        return name
+    namespace, local = name[1:].split('}', 1)
+    prefix = prefixes.get(namespace)
+    if prefix is None:
+        return name
+    return u"%s:%s" % (prefix, local)
+
+
+def toJsonML(element, namespace=None, prefixes=None):
+    """Return the JsonML for the given element. Names in the given default
+    namespace are written without a prefix. If prefixes maps namespace URIs
+    to known prefixes, these are used instead of those of the element, and
+    are not declared.
+    """
+    declared = prefixes is None
+    if declared:
+        prefixes = dict((uri, prefix) for prefix, uri
+                        in element.nsmap.items() if prefix is not None)
+
+    def convert(element):
+        tag = element.tag
+        if tag.startswith('{'):
+            uri, local = tag[1:].split('}', 1)
+            if uri == namespace:
+                tag = local
+            else:
+                tag = _qname(tag, prefixes)
+        node = [tag]
+        attributes = dict(
+            (_qname(name, prefixes), value)
+            for name, value in element.attrib.items()
+        )
+        if attributes:
+            node.append(attributes)
+        if element.text:
+            node.append(element.text)
+        for child in element.iterchildren(tag=etree.Element):
+            node.append(convert(child))
+            if child.tail:
+                node.append(child.tail)
+        return node
+
+    root = convert(element)
+    if not declared:
+        return root
+    declarations = dict(
+        (u"%s:%s" % (XMLNS, prefix), uri)
+        for prefix, uri in element.nsmap.items() if prefix is not None
+    )
+    if namespace is not None:
+        declarations[XMLNS] = namespace
+    if declarations:
+        if len(root) > 1 and isinstance(root[1], dict):
+            declarations.update(root[1])
+            root[1] = declarations
+        else:
+            root.insert(1, declarations)
+    return root
+
+
+def fromJsonML(data, namespaces=None):
+    """Return an element tree for the given JsonML. namespaces maps
+    prefixes to namespace URIs, in addition to those declared on the root
+    element. Names without a prefix are in the namespace declared with an
+    "xmlns" attribute, if any.
+    """
+    namespaces = dict(namespaces or {})
+    if len(data) > 1 and isinstance(data[1], dict):
+        for name, value in data[1].items():
+            if name == XMLNS:
+                namespaces[None] = value
+            elif name.startswith(XMLNS + u':'):
+                namespaces[name[len(XMLNS) + 1:]] = value
+
+    def resolve(name, default):
+        if u':' not in name:
+            if default is None:
+                return name
+            return u"{%s}%s" % (default, name)
+        prefix, local = name.split(u':', 1)
+        try:
+            return u"{%s}%s" % (namespaces[prefix], local)
+        except KeyError:
+            raise ValueError(u"Unknown namespace prefix %s" % prefix)
+
+    def convert(node, parent):
+        if not isinstance(node, list) or not node or \
+                not isinstance(node[0], six.string_types):
+            raise ValueError(u"Invalid JsonML element: %r" % (node, ))
+        tag = resolve(node[0], namespaces.get(None))
+        if parent is None:
+            element = etree.Element(tag, nsmap=dict(
+                (prefix, uri) for prefix, uri in namespaces.items()
+                if prefix is not None
+            ))
+        else:
+            element = etree.SubElement(parent, tag)
+
+        children = node[1:]
+        if children and isinstance(children[0], dict):
+            for name, value in children[0].items():
+                if name == XMLNS or name.startswith(XMLNS + u':'):
+                    continue
+                element.set(resolve(name, None), value)
+            children = children[1:]
+
+        last = None
+        for child in children:
+            if isinstance(child, six.string_types):
+                if last is None:
+                    element.text = (element.text or u'') + child
+                else:
+                    last.tail = (last.tail or u'') + child
+            else:
+                last = convert(child, element)
+        return element
+
+    return etree.ElementTree(convert(data, None))
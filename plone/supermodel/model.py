@@ -3,11 +3,14 @@ from plone.supermodel.interfaces import IFieldset
 from plone.supermodel.interfaces import IModel
 from plone.supermodel.interfaces import ISchema
 from plone.supermodel.interfaces import ISchemaPlugin
-from zope.component import getAdapters
+from plone.supermodel.registry import registryCache
+from zope.component import getSiteManager
 from zope.interface import Interface
 from zope.interface import implementer
+from zope.interface import providedBy
 from zope.interface.interface import InterfaceClass
 import logging
+import weakref
 import zope.deferredimport
 
 zope.deferredimport.defineFrom('plone.supermodel.directives',
@@ -26,6 +29,20 @@ else:
 logger = logging.getLogger('plone.supermodel')
 
 
+def taggedValuesGeneration(schema):
+    """Return the generation of the tagged values and bases of a
+    SchemaClass, which is incremented whenever a tagged value is set on it
+    or its bases change. Used to validate caches derived from tagged values.
+    """
+    return schema.__dict__.get('_SchemaClass_generation', 0)
+
+
+def taggedValuesChanged(schema):
+    """Invalidate caches derived from the tagged values of a SchemaClass.
+    """
+    schema._SchemaClass_generation = taggedValuesGeneration(schema) + 1
+
+
 @implementer(IFieldset)
 class Fieldset(object):
 
@@ -66,24 +83,105 @@ class SchemaClass(InterfaceClass):
         InterfaceClass.__init__(self, name, bases, attrs, __doc__, __module__)
         self._SchemaClass_finalize()
 
+    def setTaggedValue(self, tag, value):
+        InterfaceClass.setTaggedValue(self, tag, value)
+        taggedValuesChanged(self)
+
+    def changed(self, originally_changed):
+        InterfaceClass.changed(self, originally_changed)
+        taggedValuesChanged(self)
+
     def _SchemaClass_finalize(self):
-        adapters = [(getattr(adapter, 'order', 0), name, adapter)
-                    for name, adapter in getAdapters((self,), ISchemaPlugin)]
-        adapters.sort()
-        for order, name, adapter in adapters:
-            adapter()
+        factories = _schemaPlugins(self)
+        if factories:
+            adapters = []
+            for name, factory in factories:
+                tags = getattr(factory, 'taggedValues', None)
+                if tags is not None and all(
+                    self.queryTaggedValue(tag, None) is None for tag in tags
+                ):
+                    # The plugin has nothing to work on
+                    continue
+                adapter = factory(self)
+                if adapter is not None:
+                    adapters.append((getattr(adapter, 'order', 0), name,
+                                     adapter))
+            # The factories are already in order, unless an adapter has
+            # changed its order when it was created
+            adapters.sort(key=lambda item: item[:2])
+            for order, name, adapter in adapters:
+                adapter()
+        finalized = _finalizedSchemas()
+        key = id(self)
+
+        def discard(ref):
+            if finalized.get(key, None) is ref:
+                del finalized[key]
+
+        finalized[key] = weakref.ref(self, discard)
+
+    def _SchemaClass_isFinalized(self):
+        """Return True if the schema plugins have been run since the last
+        change to the adapter registrations.
+        """
+        ref = _finalizedSchemas().get(id(self), None)
+        return ref is not None and ref() is self
+
+
+def _schemaPlugins(schema):
+    """Return the (name, factory) pairs of the schema plugins for the
+    given schema, sorted by their order and name. The result is cached per
+    interface specification until the adapter registrations change.
+
+    Plugins whose factories declare taggedValues are only created by
+    SchemaClass._SchemaClass_finalize() for schemata which have at least
+    one of them.
+    """
+    adapters = getSiteManager().adapters
+    cache = registryCache(adapters).setdefault('plugins', {})
+    spec = providedBy(schema)
+    try:
+        return cache[spec]
+    except KeyError:
+        factories = cache[spec] = tuple(sorted(
+            adapters.lookupAll((spec,), ISchemaPlugin),
+            key=lambda item: (getattr(item[1], 'order', 0), item[0])
+        ))
+        return factories
+
+
+def _finalizedSchemas():
+    """Return a dict of weak references to schemata for which the plugins
+    have run, keyed by id, that is emptied whenever the adapters of the
+    current component registry change.
+    """
+    return registryCache(getSiteManager().adapters).setdefault(
+        'finalized', {}
+    )
 
 Schema = SchemaClass("Schema", (Interface,), __module__='plone.supermodel.model')
 
 
 def finalizeSchemas(parent=Schema):
     """Configuration action called after plone.supermodel is configured.
+
+    Runs the schema plugins for the parent schema and all schemata that
+    extend it, unless they have already been run since adapters were last
+    registered.
     """
     if not isinstance(parent, SchemaClass):
         raise TypeError('Only instances of plone.supermodel.model.SchemaClass can be finalized.')
 
-    def walk(schema):
-        yield schema
+    # Walk the dependents iteratively, visiting each one only once even if
+    # it can be reached along several paths.
+    seen = {}
+    stack = [parent]
+    while stack:
+        schema = stack.pop()
+        if id(schema) in seen:
+            continue
+        seen[id(schema)] = schema
+
         if getattr(schema, 'dependents', None) is None:
             # This is just a temporary fix for a issue when running Plone-tests
             # with zope4 (http://jenkins.plone.org/view/PLIPs/job/plip-zope4/).
@@ -98,13 +196,11 @@ def finalizeSchemas(parent=Schema):
             logger.info(
                 'This should not happen: "%s" has no dependents!' % schema)
         else:
-            for child in schema.dependents.keys():
-                for s in walk(child):
-                    yield s
-    schemas = set(walk(parent))
-    for schema in schemas:
+            stack.extend(schema.dependents.keys())
+
         if hasattr(schema, '_SchemaClass_finalize'):
-            schema._SchemaClass_finalize()
+            if not schema._SchemaClass_isFinalized():
+                schema._SchemaClass_finalize()
         elif isinstance(schema, InterfaceClass):
             logger.warn('%s is not an instance of SchemaClass. '
                 'This can happen if the first base class of a schema is not a '
@@ -1,27 +1,42 @@
 # -*- coding: utf-8 -*-
 from lxml import etree
 from plone.supermodel.debug import parseinfo
+from plone.supermodel.exportimport import fieldFromJSON
+from plone.supermodel.exportimport import jsonNamespaces
 from plone.supermodel.interfaces import FIELDSETS_KEY
 from plone.supermodel.interfaces import I18N_NAMESPACE
-from plone.supermodel.interfaces import IFieldExportImportHandler
-from plone.supermodel.interfaces import IFieldMetadataHandler
+from plone.supermodel.interfaces import IFieldExportImportHandler  # BBB
+from plone.supermodel.interfaces import IFieldMetadataHandler  # BBB
 from plone.supermodel.interfaces import IInvariant
-from plone.supermodel.interfaces import ISchemaMetadataHandler
+from plone.supermodel.interfaces import ISchemaMetadataHandler  # BBB
 from plone.supermodel.interfaces import ISchemaPolicy
+from plone.supermodel.interfaces import XML_NAMESPACE
+from plone.supermodel.jsonml import fromJsonML
 from plone.supermodel.model import Fieldset
 from plone.supermodel.model import Model
 from plone.supermodel.model import Schema
 from plone.supermodel.model import SchemaClass
+from plone.supermodel.registry import getHandlerTable
 from plone.supermodel.utils import ns
-from zope.component import getUtilitiesFor
 from zope.component import getUtility
-from zope.component import queryUtility
 from zope.dottedname.resolve import resolve
 from zope.interface import implementer
 from zope.schema import getFields
+import json
 import linecache
 import sys
 import six
+import threading
+
+try:
+    from collections import OrderedDict
+except:
+    from zope.schema.vocabulary import OrderedDict  # <py27
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
 
 if sys.version_info >= (3,):
     basestring = str
@@ -61,14 +76,110 @@ class DefaultSchemaPolicy(object):
         return schemaName
 
 
+# Lazily constructed schemata
+
+class LazySchemata(MutableMapping):
+    """The schemata of a model parsed with parse(..., lazy=True).
+
+    Only the <schema /> elements are kept when the model is parsed. Each
+    schema is read from its element, and its fields and metadata are
+    constructed, when it is first accessed. Functions in the onLoad list
+    are called with the name and schema of each schema read in this way.
+    """
+
+    def __init__(self, tree, elements, policy_util, handlers, fname=None):
+        self._tree = tree
+        self._names = OrderedDict((name, True) for name in elements)
+        self._pending = dict(elements)
+        self._schemata = {}
+        self._policy_util = policy_util
+        self._handlers = handlers
+        self._fname = fname
+        self._lock = threading.RLock()
+        self.onLoad = []
+
+    def __getitem__(self, name):
+        try:
+            return self._schemata[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name in self._schemata:
+                return self._schemata[name]
+            schema = self._read(self._pending[name])
+            for callback in self.onLoad:
+                callback(name, schema)
+            self._schemata[name] = schema
+            del self._pending[name]
+            if not self._pending:
+                # Everything has been read, so the document can go
+                self._tree = None
+            return schema
+
+    def __setitem__(self, name, schema):
+        with self._lock:
+            self._names[name] = True
+            self._pending.pop(name, None)
+            self._schemata[name] = schema
+
+    def __delitem__(self, name):
+        with self._lock:
+            del self._names[name]
+            self._pending.pop(name, None)
+            self._schemata.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def isLoaded(self, name):
+        """Return True if the named schema has been constructed already.
+        """
+        return name in self._schemata
+
+    def loadAll(self):
+        """Construct all schemata that have not been accessed yet.
+        """
+        for name in self:
+            self[name]
+
+    def _read(self, schema_element):
+        root = schema_element.getparent()
+        parseinfo.i18n_domain = root.attrib.get(ns('domain', prefix=I18N_NAMESPACE))
+        try:
+            schemaName, schema = _readSchema(schema_element, self._tree,
+                                             self._policy_util, self._handlers)
+        except Exception as e:
+            six.reraise(SupermodelParseError, SupermodelParseError(
+                e,
+                self._fname,
+                parseinfo.stack[-1]
+            ), sys.exc_info()[2])
+        finally:
+            parseinfo.i18n_domain = None
+        return schema
+
+
 # Algorithm
 
-def parse(source, policy=u""):
+def parse(source, policy=u"", lazy=False):
+    """Parse the model in source. If lazy is True, the schemata of the
+    returned model are only constructed when they are first accessed (see
+    LazySchemata).
+    """
     fname = None
     if isinstance(source, basestring):
         fname = source
 
     try:
+        if lazy:
+            return _lazyparse(source, policy, fname)
         return _parse(source, policy)
     except Exception as e:
         # Re-package the exception as a parse error that will get rendered with
@@ -82,142 +193,385 @@ def parse(source, policy=u""):
         ), sys.exc_info()[2])
 
 
-def _parse(source, policy):
-    tree = etree.parse(source)
-    root = tree.getroot()
+def iterparse(source, policy=u""):
+    """Parse the model in source incrementally, yielding a
+    (schemaName, schema) pair as soon as each <schema /> element has been
+    read. Elements that have been processed are discarded, so that only one
+    schema of the document is held in memory at a time.
 
-    parseinfo.i18n_domain = root.attrib.get(ns('domain', prefix=I18N_NAMESPACE))
+    The tree passed to the schema policy only contains the part of the
+    document that has been read so far.
+    """
+    fname = None
+    if isinstance(source, basestring):
+        fname = source
+
+    try:
+        for item in _iterparse(source, policy):
+            yield item
+    except Exception as e:
+        six.reraise(SupermodelParseError, SupermodelParseError(
+            e,
+            fname,
+            parseinfo.stack[-1]
+        ), sys.exc_info()[2])
+
+
+def _readField(handlers, fieldElement, schemaAttributes, fieldElements,
+               baseFields):
+
+    # Parse field attributes
+    fieldName = fieldElement.get('name')
+    fieldType = fieldElement.get('type')
+
+    if fieldName is None or fieldType is None:
+        raise ValueError("The attributes 'name' and 'type' are required for each <field /> element")
+
+    handler = handlers.fieldHandler(fieldType)
+    if handler is None:
+        raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName, ))
+
+    field = handler.read(fieldElement)
+
+    # Preserve order from base interfaces if this field is an override
+    # of a field with the same name in a base interface
+    base_field = baseFields.get(fieldName, None)
+    if base_field is not None:
+        field.order = base_field.order
+
+    # Save for the schema
+    schemaAttributes[fieldName] = field
+    fieldElements[fieldName] = fieldElement
+
+    return fieldName
 
-    model = Model()
 
-    handlers = {}
-    schema_metadata_handlers = tuple(getUtilitiesFor(ISchemaMetadataHandler))
-    field_metadata_handlers = tuple(getUtilitiesFor(IFieldMetadataHandler))
+def _readSchema(schema_element, tree, policy_util, handlers):
+    parseinfo.stack.append(schema_element)
+    schemaAttributes = {}
 
+    schemaName = schema_element.get('name')
+    if schemaName is None:
+        schemaName = u""
+
+    bases = ()
+    baseFields = {}
+    based_on = schema_element.get('based-on')
+    if based_on is not None:
+        bases = tuple([resolve(dotted) for dotted in based_on.split()])
+        for base_schema in bases:
+            baseFields.update(getFields(base_schema))
+
+    fieldElements = {}
+
+    # Read global fields
+    for fieldElement in schema_element.findall(ns('field')):
+        parseinfo.stack.append(fieldElement)
+        _readField(handlers, fieldElement, schemaAttributes, fieldElements,
+                   baseFields)
+        parseinfo.stack.pop()
+
+    # Read invariants, fieldsets and their fields
+    invariants = []
+    fieldsets = []
+    fieldsets_by_name = {}
+
+    for subelement in schema_element:
+        parseinfo.stack.append(subelement)
+
+        if subelement.tag == ns('field'):
+            _readField(handlers, subelement, schemaAttributes, fieldElements,
+                       baseFields)
+        elif subelement.tag == ns('fieldset'):
+
+            fieldset_name = subelement.get('name')
+            if fieldset_name is None:
+                raise ValueError(u"Fieldset in schema %s has no name" % (schemaName))
+
+            fieldset = fieldsets_by_name.get(fieldset_name, None)
+            if fieldset is None:
+                fieldset_label = subelement.get('label')
+                fieldset_description = subelement.get('description')
+
+                fieldset = fieldsets_by_name[fieldset_name] = Fieldset(fieldset_name,
+                                label=fieldset_label, description=fieldset_description)
+                fieldsets_by_name[fieldset_name] = fieldset
+                fieldsets.append(fieldset)
+
+            for fieldElement in subelement.findall(ns('field')):
+                parseinfo.stack.append(fieldElement)
+                parsed_fieldName = _readField(handlers, fieldElement,
+                                              schemaAttributes, fieldElements,
+                                              baseFields)
+                if parsed_fieldName:
+                    fieldset.fields.append(parsed_fieldName)
+                parseinfo.stack.pop()
+        elif subelement.tag == ns('invariant'):
+            invariants.append(_resolveInvariant(subelement.text))
+        parseinfo.stack.pop()
+
+    schema = _makeSchema(schemaName, tree, policy_util, bases,
+                         schemaAttributes, invariants, fieldsets)
+
+    _readMetadata(handlers, schema, schema_element, fieldElements)
+
+    parseinfo.stack.pop()
+    return schemaName, schema
+
+
+def _resolveInvariant(dotted):
+    invariant = resolve(dotted)
+    if not IInvariant.providedBy(invariant):
+        raise ImportError(
+            u"Invariant functions must provide plone.supermodel.interfaces.IInvariant"
+        )
+    return invariant
+
+
+def _makeSchema(schemaName, tree, policy_util, bases, schemaAttributes,
+                invariants, fieldsets):
+    schema = SchemaClass(name=policy_util.name(schemaName, tree),
+                            bases=bases + policy_util.bases(schemaName, tree) + (Schema,),
+                            __module__=policy_util.module(schemaName, tree),
+                            attrs=schemaAttributes)
+
+    # add invariants to schema as tagged values
+    if invariants:
+        schema_invariants = schema.queryTaggedValue('invariants', [])
+        schema.setTaggedValue('invariants', schema_invariants + invariants)
+
+    # Save fieldsets
+    schema.setTaggedValue(FIELDSETS_KEY, fieldsets)
+
+    return schema
+
+
+def _readMetadata(handlers, schema, schema_element, fieldElements):
+    # Let metadata handlers write metadata
+    for handler_name, metadata_handler in handlers.fieldMetadataHandlers:
+        for fieldName in schema:
+            if fieldName in fieldElements:
+                metadata_handler.read(fieldElements[fieldName], schema, schema[fieldName])
+
+    for handler_name, metadata_handler in handlers.schemaMetadataHandlers:
+        metadata_handler.read(schema_element, schema)
+
+
+def parseJSON(data, policy=u""):
+    """Parse a model from the JSON written by serializer.serializeJSON(),
+    given as a JSON string or as the decoded object.
+
+    Fields are constructed directly from their JSON objects by the readJSON()
+    method of their handlers. Metadata handlers read elements that hold
+    their attributes and elements, which are built from the JsonML that was
+    written for them. Schema policies are passed the decoded object instead
+    of an element tree.
+    """
+    try:
+        if isinstance(data, (six.text_type, bytes)):
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            data = json.loads(data, object_pairs_hook=OrderedDict)
+        return _parseJSON(data, policy)
+    except Exception as e:
+        six.reraise(SupermodelParseError, SupermodelParseError(
+            e,
+            None,
+            parseinfo.stack[-1]
+        ), sys.exc_info()[2])
+
+
+def _parseJSON(data, policy):
+    if not isinstance(data, dict):
+        raise ValueError(u"A JSON model must be an object")
+
+    model = Model()
+
+    handlers = getHandlerTable()
     policy_util = getUtility(ISchemaPolicy, name=policy)
 
-    def readField(fieldElement, schemaAttributes, fieldElements, baseFields):
+    # Elements for metadata handlers are only built if there are any
+    namespaces = None
+    if handlers.fieldMetadataHandlers or handlers.schemaMetadataHandlers:
+        namespaces = dict((prefix, uri) for uri, prefix
+                          in jsonNamespaces().items())
+        namespaces[None] = XML_NAMESPACE
+
+    parseinfo.i18n_domain = data.get('i18n:domain')
+    try:
+        for schemaName, schema_data in data.get('schemata', {}).items():
+            model.schemata[schemaName] = _readJSONSchema(
+                schemaName, schema_data, data, policy_util, handlers,
+                namespaces)
+    finally:
+        parseinfo.i18n_domain = None
+
+    return model
+
+
+def _metadataElement(node, tag, namespaces):
+    """Return the element that metadata handlers read, built from the
+    JsonML that was written for them, if any.
+    """
+    if node is None:
+        return etree.Element(ns(tag))
+    return fromJsonML(node, namespaces).getroot()
 
-        # Parse field attributes
-        fieldName = fieldElement.get('name')
-        fieldType = fieldElement.get('type')
 
-        if fieldName is None or fieldType is None:
-            raise ValueError("The attributes 'name' and 'type' are required for each <field /> element")
+def _readJSONField(handlers, data, schemaAttributes, baseFields,
+                   parentElement, fieldElements, namespaces):
+    fieldName = data.get('name')
+    fieldType = data.get('type')
 
-        handler = handlers.get(fieldType, None)
-        if handler is None:
-            handler = handlers[fieldType] = queryUtility(IFieldExportImportHandler, name=fieldType)
-            if handler is None:
-                raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName, ))
+    if fieldName is None or fieldType is None:
+        raise ValueError("The keys 'name' and 'type' are required for each field")
 
-        field = handler.read(fieldElement)
+    handler = handlers.fieldHandler(fieldType)
+    if handler is None:
+        raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName, ))
 
-        # Preserve order from base interfaces if this field is an override
-        # of a field with the same name in a base interface
-        base_field = baseFields.get(fieldName, None)
-        if base_field is not None:
-            field.order = base_field.order
+    field = fieldFromJSON(handler, data)
 
-        # Save for the schema
-        schemaAttributes[fieldName] = field
+    base_field = baseFields.get(fieldName, None)
+    if base_field is not None:
+        field.order = base_field.order
+
+    schemaAttributes[fieldName] = field
+
+    if parentElement is not None:
+        fieldElement = _metadataElement(data.get('metadata'), 'field',
+                                        namespaces)
+        fieldElement.set('name', fieldName)
+        fieldElement.set('type', fieldType)
+        parentElement.append(fieldElement)
         fieldElements[fieldName] = fieldElement
 
-        return fieldName
+    return fieldName
+
+
+def _readJSONSchema(schemaName, data, document, policy_util, handlers,
+                    namespaces):
+    schemaAttributes = {}
+
+    bases = ()
+    baseFields = {}
+    based_on = data.get('based-on')
+    if based_on:
+        bases = tuple([resolve(dotted) for dotted in based_on])
+        for base_schema in bases:
+            baseFields.update(getFields(base_schema))
+
+    # The <schema /> element for metadata handlers, with a <field />
+    # element for each field
+    schema_element = None
+    fieldElements = {}
+    if namespaces is not None:
+        schema_element = _metadataElement(data.get('metadata'), 'schema',
+                                          namespaces)
+        if schemaName:
+            schema_element.set('name', schemaName)
+        if based_on:
+            schema_element.set('based-on', ' '.join(based_on))
+
+    for fieldData in data.get('fields', ()):
+        _readJSONField(handlers, fieldData, schemaAttributes, baseFields,
+                       schema_element, fieldElements, namespaces)
+
+    fieldsets = []
+    fieldsets_by_name = {}
+
+    for fieldsetData in data.get('fieldsets', ()):
+        fieldset_name = fieldsetData.get('name')
+        if fieldset_name is None:
+            raise ValueError(u"Fieldset in schema %s has no name" % (schemaName))
+
+        fieldset = fieldsets_by_name.get(fieldset_name, None)
+        if fieldset is None:
+            fieldset = fieldsets_by_name[fieldset_name] = Fieldset(
+                fieldset_name,
+                label=fieldsetData.get('label'),
+                description=fieldsetData.get('description'))
+            fieldsets.append(fieldset)
+
+        fieldset_element = None
+        if schema_element is not None:
+            fieldset_element = etree.SubElement(schema_element,
+                                                ns('fieldset'))
+            fieldset_element.set('name', fieldset_name)
+
+        for fieldData in fieldsetData.get('fields', ()):
+            fieldset.fields.append(_readJSONField(
+                handlers, fieldData, schemaAttributes, baseFields,
+                fieldset_element, fieldElements, namespaces))
+
+    invariants = [_resolveInvariant(dotted)
+                  for dotted in data.get('invariants', ())]
+
+    schema = _makeSchema(schemaName, document, policy_util, bases,
+                         schemaAttributes, invariants, fieldsets)
+
+    if schema_element is not None:
+        _readMetadata(handlers, schema, schema_element, fieldElements)
+
+    return schema
 
-    for schema_element in root.findall(ns('schema')):
-        parseinfo.stack.append(schema_element)
-        schemaAttributes = {}
-
-        schemaName = schema_element.get('name')
-        if schemaName is None:
-            schemaName = u""
-
-        bases = ()
-        baseFields = {}
-        based_on = schema_element.get('based-on')
-        if based_on is not None:
-            bases = tuple([resolve(dotted) for dotted in based_on.split()])
-            for base_schema in bases:
-                baseFields.update(getFields(base_schema))
-
-        fieldElements = {}
-
-        # Read global fields
-        for fieldElement in schema_element.findall(ns('field')):
-            parseinfo.stack.append(fieldElement)
-            readField(fieldElement, schemaAttributes, fieldElements, baseFields)
-            parseinfo.stack.pop()
-
-        # Read invariants, fieldsets and their fields
-        invariants = []
-        fieldsets = []
-        fieldsets_by_name = {}
-
-        for subelement in schema_element:
-            parseinfo.stack.append(subelement)
-
-            if subelement.tag == ns('field'):
-                readField(subelement, schemaAttributes, fieldElements, baseFields)
-            elif subelement.tag == ns('fieldset'):
-
-                fieldset_name = subelement.get('name')
-                if fieldset_name is None:
-                    raise ValueError(u"Fieldset in schema %s has no name" % (schemaName))
-
-                fieldset = fieldsets_by_name.get(fieldset_name, None)
-                if fieldset is None:
-                    fieldset_label = subelement.get('label')
-                    fieldset_description = subelement.get('description')
-
-                    fieldset = fieldsets_by_name[fieldset_name] = Fieldset(fieldset_name,
-                                    label=fieldset_label, description=fieldset_description)
-                    fieldsets_by_name[fieldset_name] = fieldset
-                    fieldsets.append(fieldset)
-
-                for fieldElement in subelement.findall(ns('field')):
-                    parseinfo.stack.append(fieldElement)
-                    parsed_fieldName = readField(fieldElement, schemaAttributes, fieldElements, baseFields)
-                    if parsed_fieldName:
-                        fieldset.fields.append(parsed_fieldName)
-                    parseinfo.stack.pop()
-            elif subelement.tag == ns('invariant'):
-                dotted = subelement.text
-                invariant = resolve(dotted)
-                if not IInvariant.providedBy(invariant):
-                    raise ImportError(
-                        u"Invariant functions must provide plone.supermodel.interfaces.IInvariant"
-                    )
-                invariants.append(invariant)
-            parseinfo.stack.pop()
-
-        schema = SchemaClass(name=policy_util.name(schemaName, tree),
-                                bases=bases + policy_util.bases(schemaName, tree) + (Schema,),
-                                __module__=policy_util.module(schemaName, tree),
-                                attrs=schemaAttributes)
-
-        # add invariants to schema as tagged values
-        if invariants:
-            schema_invariants = schema.queryTaggedValue('invariants', [])
-            schema.setTaggedValue('invariants', schema_invariants + invariants)
-
-        # Save fieldsets
-        schema.setTaggedValue(FIELDSETS_KEY, fieldsets)
-
-        # Let metadata handlers write metadata
-        for handler_name, metadata_handler in field_metadata_handlers:
-            for fieldName in schema:
-                if fieldName in fieldElements:
-                    metadata_handler.read(fieldElements[fieldName], schema, schema[fieldName])
-
-        for handler_name, metadata_handler in schema_metadata_handlers:
-            metadata_handler.read(schema_element, schema)
 
+def _parse(source, policy):
+    tree = etree.parse(source)
+    root = tree.getroot()
+
+    parseinfo.i18n_domain = root.attrib.get(ns('domain', prefix=I18N_NAMESPACE))
+
+    model = Model()
+
+    handlers = getHandlerTable()
+    policy_util = getUtility(ISchemaPolicy, name=policy)
+
+    for schema_element in root.findall(ns('schema')):
+        schemaName, schema = _readSchema(schema_element, tree, policy_util,
+                                         handlers)
         model.schemata[schemaName] = schema
-        parseinfo.stack.pop()
 
     parseinfo.i18n_domain = None
     return model
 
 
-__all__ = ('parse', )
+def _lazyparse(source, policy, fname):
+    tree = etree.parse(source)
+    root = tree.getroot()
+
+    handlers = getHandlerTable()
+    policy_util = getUtility(ISchemaPolicy, name=policy)
+
+    elements = OrderedDict()
+    for schema_element in root.findall(ns('schema')):
+        elements[schema_element.get('name') or u""] = schema_element
+
+    return Model(LazySchemata(tree, elements, policy_util, handlers, fname))
+
+
+def _iterparse(source, policy):
+    handlers = getHandlerTable()
+    policy_util = getUtility(ISchemaPolicy, name=policy)
+
+    for event, schema_element in etree.iterparse(source, tag=ns('schema')):
+        # Only <schema /> elements directly inside <model /> are schemata
+        root = schema_element.getparent()
+        if root is None or root.getparent() is not None:
+            continue
+
+        parseinfo.i18n_domain = root.attrib.get(ns('domain', prefix=I18N_NAMESPACE))
+        schemaName, schema = _readSchema(schema_element,
+                                         schema_element.getroottree(),
+                                         policy_util, handlers)
+        parseinfo.i18n_domain = None
+
+        # Discard this schema and everything that came before it
+        schema_element.clear()
+        while schema_element.getprevious() is not None:
+            del root[0]
+
+        yield schemaName, schema
+
+
+__all__ = ('parse', 'parseJSON', 'iterparse', 'LazySchemata', )
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from plone.supermodel.interfaces import IFieldExportImportHandler
+from plone.supermodel.interfaces import IFieldMetadataHandler
+from plone.supermodel.interfaces import IFieldNameExtractor
+from plone.supermodel.interfaces import ISchemaMetadataHandler
+from zope.component import getSiteManager
+from zope.component import getUtilitiesFor
+from zope.component import queryUtility
+from zope.interface import providedBy
+import weakref
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def generation(registry):
+    """Return a value that changes whenever something is registered in or
+    unregistered from the given adapter registry or any of its bases.
+    """
+    return tuple([r._generation for r in registry.ro])
+
+
+def registryCache(registry):
+    """Return a dict that can be used to cache lookups in the given adapter
+    registry (i.e. the adapters or utilities of a component registry). A
+    new, empty dict is returned once the registrations have changed.
+    """
+    current = generation(registry)
+    entry = _caches.get(registry, None)
+    if entry is None or entry[0] != current:
+        entry = _caches[registry] = (current, {})
+    return entry[1]
+
+
+class HandlerTable(object):
+    """The field handlers and metadata handlers registered in a component
+    registry.
+    """
+
+    def __init__(self):
+        self._fieldHandlers = {}
+        self.schemaMetadataHandlers = tuple(
+            getUtilitiesFor(ISchemaMetadataHandler)
+        )
+        self.fieldMetadataHandlers = tuple(
+            getUtilitiesFor(IFieldMetadataHandler)
+        )
+
+    def fieldHandler(self, fieldType):
+        """Return the IFieldExportImportHandler for the given field type, or
+        None.
+        """
+        try:
+            return self._fieldHandlers[fieldType]
+        except KeyError:
+            handler = self._fieldHandlers[fieldType] = queryUtility(
+                IFieldExportImportHandler,
+                name=fieldType
+            )
+            return handler
+
+
+def getHandlerTable():
+    """Return the handler table for the current component registry.
+    """
+    cache = registryCache(getSiteManager().utilities)
+    table = cache.get('handlers', None)
+    if table is None:
+        table = cache['handlers'] = HandlerTable()
+    return table
+
+
+def fieldTypeName(field):
+    """Return the field type name of the given field, as returned by its
+    IFieldNameExtractor adapter. The adapter factory is looked up once per
+    interface specification until the adapter registrations change.
+    """
+    if IFieldNameExtractor.providedBy(field):
+        return field()
+
+    adapters = getSiteManager().adapters
+    cache = registryCache(adapters).setdefault('extractors', {})
+    spec = providedBy(field)
+    try:
+        factory = cache[spec]
+    except KeyError:
+        factory = cache[spec] = adapters.lookup((spec, ), IFieldNameExtractor)
+    if factory is None:
+        # Let the component architecture report the problem
+        return IFieldNameExtractor(field)()
+    return factory(field)()
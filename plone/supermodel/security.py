@@ -20,6 +20,9 @@ class SecuritySchema(object):
     namespace = SECURITY_NAMESPACE
     prefix = SECURITY_PREFIX
 
+    # write() does not write i18n attributes; see utils.recordsI18n()
+    i18nRecorded = True
+
     def read(self, fieldNode, schema, field):
         name = field.__name__
 
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
 from lxml import etree
+from plone.supermodel.debug import serializeinfo
+from plone.supermodel.exportimport import fieldToJSON
+from plone.supermodel.exportimport import jsonNamespaces
 from plone.supermodel.interfaces import FIELDSETS_KEY
 from plone.supermodel.interfaces import I18N_NAMESPACE
-from plone.supermodel.interfaces import IFieldExportImportHandler
-from plone.supermodel.interfaces import IFieldMetadataHandler
 from plone.supermodel.interfaces import IFieldNameExtractor
-from plone.supermodel.interfaces import ISchemaMetadataHandler
 from plone.supermodel.interfaces import XML_NAMESPACE
+from plone.supermodel.jsonml import toJsonML
 from plone.supermodel.model import Schema
+from plone.supermodel.registry import fieldTypeName
+from plone.supermodel.registry import getHandlerTable
 from plone.supermodel.utils import ns
 from plone.supermodel.utils import prettyXML
+from plone.supermodel.utils import recordI18nNodes
+from plone.supermodel.utils import recordsI18n
 from plone.supermodel.utils import sortedFields
 from zope.component import adapter
-from zope.component import getUtilitiesFor
-from zope.component import queryUtility
 from zope.interface import implementer
 from zope.schema.interfaces import IField
+import json
+
+try:
+    from collections import OrderedDict
+except:
+    from zope.schema.vocabulary import OrderedDict  # <py27
 
 
 @implementer(IFieldNameExtractor)
@@ -41,14 +50,25 @@ class DefaultFieldNameExtractor(object):
         return "%s.%s" % (field_module, self.context.__class__.__name__)
 
 
-# Algorithm
+# Output modes
+
+# Indented in the same way as by earlier versions of plone.supermodel
+COMPAT = 'compat'
 
+# Indented by lxml
+PRETTY = 'pretty'
 
-def serialize(model):
+# Not indented at all
+COMPACT = 'compact'
 
-    handlers = {}
-    schema_metadata_handlers = tuple(getUtilitiesFor(ISchemaMetadataHandler))
-    field_metadata_handlers = tuple(getUtilitiesFor(IFieldMetadataHandler))
+
+# Algorithm
+
+
+def serialize(model, mode=COMPAT):
+    handlers = getHandlerTable()
+    schema_metadata_handlers = handlers.schemaMetadataHandlers
+    field_metadata_handlers = handlers.fieldMetadataHandlers
 
     nsmap = {'i18n': I18N_NAMESPACE}
     for name, handler in schema_metadata_handlers + field_metadata_handlers:
@@ -59,14 +79,19 @@ def serialize(model):
     xml = etree.Element('model', nsmap=nsmap)
     xml.set('xmlns', XML_NAMESPACE)
 
-    def writeField(field, parentElement):
-        name_extractor = IFieldNameExtractor(field)
-        fieldType = name_extractor()
-        handler = handlers.get(fieldType, None)
+    # Handlers that may write i18n attributes themselves, whose elements
+    # have to be searched for them
+    fields_searched = not all(recordsI18n(metadata_handler) for name,
+                              metadata_handler in field_metadata_handlers)
+    schemata_searched = not all(recordsI18n(metadata_handler) for name,
+                                metadata_handler in schema_metadata_handlers)
+
+    def writeField(schema, fieldName, field, parentElement):
+        fieldType = fieldTypeName(field)
+        handler = handlers.fieldHandler(fieldType)
         if handler is None:
-            handler = handlers[fieldType] = queryUtility(IFieldExportImportHandler, name=fieldType)
-            if handler is None:
-                raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName))
+            raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName))
+        start = len(i18n_nodes)
         fieldElement = handler.write(field, fieldName, fieldType)
         if fieldElement is not None:
             parentElement.append(fieldElement)
@@ -74,7 +99,11 @@ def serialize(model):
             for handler_name, metadata_handler in field_metadata_handlers:
                 metadata_handler.write(fieldElement, schema, field)
 
-    for schemaName, schema in model.schemata.items():
+            if fields_searched or not recordsI18n(handler):
+                recordI18nNodes(fieldElement, start)
+
+    def writeSchema(schemaName, schema):
+        start = len(i18n_nodes)
 
         fieldsets = schema.queryTaggedValue(FIELDSETS_KEY, [])
 
@@ -100,7 +129,7 @@ def serialize(model):
 
         for fieldName in non_fieldset_fields:
             field = schema[fieldName]
-            writeField(field, schema_element)
+            writeField(schema, fieldName, field, schema_element)
 
         for fieldset in fieldsets:
 
@@ -113,18 +142,36 @@ def serialize(model):
 
             for fieldName in fieldset.fields:
                 field = schema[fieldName]
-                writeField(field, fieldset_element)
+                writeField(schema, fieldName, field, fieldset_element)
 
             schema_element.append(fieldset_element)
 
         for handler_name, metadata_handler in schema_metadata_handlers:
             metadata_handler.write(schema_element, schema)
 
+        if schemata_searched:
+            recordI18nNodes(schema_element, start)
+
         xml.append(schema_element)
 
+    # Elements are written in document order. utils.valueToElement() keeps
+    # track of those that have i18n attributes, so that we can move the
+    # i18n domain to the root element below without searching the tree.
+    # Only the elements written by handlers which do not declare that
+    # they use it are searched.
+    serializeinfo.i18n_nodes = i18n_nodes = []
+    try:
+        for schemaName, schema in model.schemata.items():
+            writeSchema(schemaName, schema)
+    finally:
+        serializeinfo.i18n_nodes = None
+
     # handle i18n
     i18n_domain = xml.get(ns('domain', prefix=I18N_NAMESPACE))
-    for node in xml.xpath('//*[@i18n:translate]', namespaces=nsmap):
+    for node in i18n_nodes:
+        if node.getroottree().getroot() is not xml:
+            # Not used after all
+            continue
         domain = node.get(ns('domain', prefix=I18N_NAMESPACE), i18n_domain)
         if i18n_domain is None:
             i18n_domain = domain
@@ -133,7 +180,180 @@ def serialize(model):
     if i18n_domain:
         xml.set(ns('domain', prefix=I18N_NAMESPACE), i18n_domain)
 
-    return prettyXML(xml)
+    if mode == COMPACT:
+        return etree.tostring(xml)
+    return prettyXML(xml, native=(mode == PRETTY))
+
 
+def _metadataJSON(element, ignored, prefixes):
+    """Return the JsonML for what metadata handlers wrote to the given
+    element, or None if they did not write anything.
+    """
+    node = toJsonML(element, prefixes=prefixes)
+    if len(node) > 1 and isinstance(node[1], dict):
+        for name in ignored:
+            node[1].pop(name, None)
+        if not node[1]:
+            del node[1]
+    if len(node) > 1:
+        return node
+    return None
+
+
+def serializeJSON(model):
+    """Serialize a model to a JSON string.
+
+    Fields are written as objects holding their attributes by the
+    writeJSON() method of their handlers. Metadata handlers write to
+    <schema /> and <field /> elements that only hold the names and types of
+    the fields, and what they wrote is kept as JsonML in 'metadata'.
+    """
+    handlers = getHandlerTable()
+    schema_metadata_handlers = handlers.schemaMetadataHandlers
+    field_metadata_handlers = handlers.fieldMetadataHandlers
+
+    # Elements for metadata handlers are only built if there are any
+    metadata = bool(schema_metadata_handlers or field_metadata_handlers)
+    prefixes = jsonNamespaces()
+    nsmap = dict((prefix, uri) for uri, prefix in prefixes.items())
+
+    fields_searched = not all(recordsI18n(metadata_handler) for name,
+                              metadata_handler in field_metadata_handlers)
+    schemata_searched = not all(recordsI18n(metadata_handler) for name,
+                                metadata_handler in schema_metadata_handlers)
+
+    def writeField(schema, fieldName, field, parentElement, written):
+        fieldType = fieldTypeName(field)
+        handler = handlers.fieldHandler(fieldType)
+        if handler is None:
+            raise ValueError("Field type %s specified for field %s is not supported" % (fieldType, fieldName))
+        fieldData = fieldToJSON(handler, field, fieldName, fieldType)
+        if fieldData is not None and parentElement is not None:
+            start = len(i18n_nodes)
+            fieldElement = etree.SubElement(parentElement, 'field')
+            fieldElement.set('name', fieldName)
+            fieldElement.set('type', fieldType)
+
+            for handler_name, metadata_handler in field_metadata_handlers:
+                metadata_handler.write(fieldElement, schema, field)
 
-__all__ = ('serialize', )
+            if fields_searched:
+                recordI18nNodes(fieldElement, start)
+
+            written.append((fieldData, fieldElement))
+        return fieldData
+
+    def writeSchema(schemaName, schema):
+        fieldsets = schema.queryTaggedValue(FIELDSETS_KEY, [])
+
+        fieldset_fields = set()
+        for fieldset in fieldsets:
+            fieldset_fields.update(fieldset.fields)
+
+        data = OrderedDict()
+
+        bases = [b.__identifier__ for b in schema.__bases__ if b is not Schema]
+        if bases:
+            data['based-on'] = bases
+
+        invariants = schema.queryTaggedValue('invariants', [])
+        if invariants:
+            data['invariants'] = [
+                "%s.%s" % (invariant.__module__, invariant.__name__)
+                for invariant in invariants
+            ]
+
+        schema_element = None
+        if metadata:
+            schema_element = etree.Element('schema', nsmap=nsmap)
+            if schemaName:
+                schema_element.set('name', schemaName)
+            if bases:
+                schema_element.set('based-on', ' '.join(bases))
+
+        # The JSON objects of the fields and the elements written for them
+        written = []
+
+        fields = []
+        for fieldName, field in sortedFields(schema):
+            if fieldName not in fieldset_fields:
+                fieldData = writeField(schema, fieldName, field,
+                                       schema_element, written)
+                if fieldData is not None:
+                    fields.append(fieldData)
+        if fields:
+            data['fields'] = fields
+
+        fieldsets_data = []
+        for fieldset in fieldsets:
+            fieldset_data = OrderedDict()
+            fieldset_data['name'] = fieldset.__name__
+            if fieldset.label:
+                fieldset_data['label'] = fieldset.label
+            if fieldset.description:
+                fieldset_data['description'] = fieldset.description
+
+            fieldset_element = None
+            if schema_element is not None:
+                fieldset_element = etree.SubElement(schema_element,
+                                                    'fieldset')
+                fieldset_element.set('name', fieldset.__name__)
+
+            fields = []
+            for fieldName in fieldset.fields:
+                fieldData = writeField(schema, fieldName, schema[fieldName],
+                                       fieldset_element, written)
+                if fieldData is not None:
+                    fields.append(fieldData)
+            fieldset_data['fields'] = fields
+            fieldsets_data.append(fieldset_data)
+        if fieldsets_data:
+            data['fieldsets'] = fieldsets_data
+
+        if schema_element is not None:
+            start = len(i18n_nodes)
+            for handler_name, metadata_handler in schema_metadata_handlers:
+                metadata_handler.write(schema_element, schema)
+
+            if schemata_searched:
+                recordI18nNodes(schema_element, start)
+
+            for fieldData, fieldElement in written:
+                node = _metadataJSON(fieldElement, ('name', 'type'),
+                                     prefixes)
+                if node is not None:
+                    fieldData['metadata'] = node
+
+            for child in list(schema_element):
+                if child.tag in ('field', 'fieldset'):
+                    schema_element.remove(child)
+            node = _metadataJSON(schema_element, ('name', 'based-on'),
+                                 prefixes)
+            if node is not None:
+                data['metadata'] = node
+
+        return data
+
+    # Metadata handlers and field handlers without JSON support record the
+    # elements with i18n attributes, as in serialize(). Their domain is
+    # kept on each element, and the first one is also the default domain
+    # with which the elements are read.
+    serializeinfo.i18n_nodes = i18n_nodes = []
+    schemata = OrderedDict()
+    try:
+        for schemaName, schema in model.schemata.items():
+            schemata[schemaName] = writeSchema(schemaName, schema)
+    finally:
+        serializeinfo.i18n_nodes = None
+
+    result = OrderedDict()
+    for node in i18n_nodes:
+        domain = node.get(ns('domain', prefix=I18N_NAMESPACE))
+        if domain:
+            result['i18n:domain'] = domain
+            break
+    result['schemata'] = schemata
+    return json.dumps(result)
+
+
+__all__ = ('serialize', 'serializeJSON', )
@@ -3,6 +3,8 @@ from io import BytesIO
 from io import StringIO
 from lxml import etree
 from plone.supermodel.exportimport import ChoiceHandler
+from plone.supermodel import cache
+from plone.supermodel import compiled
 from plone.supermodel import directives
 from plone.supermodel import model
 from plone.supermodel import utils
@@ -23,8 +25,13 @@ from zope.schema.interfaces import IContextSourceBinder
 from zope.schema.vocabulary import SimpleTerm
 from zope.schema.vocabulary import SimpleVocabulary
 import doctest
+import gc
+import hashlib
+import os
 import re
+import shutil
 import sys
+import tempfile
 import unittest
 import zope.component.testing
 
@@ -81,6 +88,13 @@ class IBase(Interface):
     description = schema.TextLine(title=u"Description")
     name = schema.TextLine(title=u"Name")
 
+
+class ITaggedBase(Interface):
+    pass
+
+
+ITaggedBase.setTaggedValue(u"plone.supermodel.tests.base", u"base")
+
 # Used in fields.txt
 
 
@@ -334,6 +348,153 @@ class TestUtils(unittest.TestCase):
 
         self.assertTrue(IDest['one'].interface is IDest)
 
+    def test_syncSchema_diff(self):
+
+        class ISource(Interface):
+            one = schema.TextLine(title=u"A")
+            two = schema.Int(title=u"B")
+
+        class IDest(Interface):
+            pass
+
+        ISource.setTaggedValue("tag1", ["tag one"])
+
+        changes = utils.syncSchema(ISource, IDest, overwrite=True, diff=True)
+        self.assertEqual(['one', 'two'], changes['added'])
+        self.assertEqual(['tag1'], changes['taggedValues'])
+        one = IDest['one']
+
+        # Nothing changed
+        changes = utils.syncSchema(ISource, IDest, overwrite=True, diff=True)
+        self.assertEqual({'added': [], 'changed': [], 'moved': [],
+                          'removed': [], 'taggedValues': [], 'bases': False},
+                         changes)
+        self.assertTrue(IDest['one'] is one)
+
+        class ISource2(Interface):
+            one = schema.TextLine(title=u"A")
+            three = schema.List(value_type=schema.Int())
+
+        ISource2.setTaggedValue("tag1", ["tag one"])
+        changes = utils.syncSchema(ISource2, IDest, overwrite=True, diff=True)
+        self.assertEqual(['three'], changes['added'])
+        self.assertEqual(['two'], changes['removed'])
+        self.assertEqual([], changes['changed'])
+        self.assertEqual([], changes['taggedValues'])
+        self.assertTrue(IDest['one'] is one)
+        self.assertEqual(['one', 'three'], getFieldNamesInOrder(IDest))
+
+        ISource2['one'].title = u"Changed"
+        ISource2['three'].value_type = schema.Int(min=1)
+        changes = utils.syncSchema(ISource2, IDest, overwrite=True, diff=True)
+        self.assertEqual(['one', 'three'], changes['changed'])
+        self.assertEqual(u"Changed", IDest['one'].title)
+        self.assertTrue(IDest['one'].interface is IDest)
+
+        # Reordered fields are copied again, so that dest has the same order
+        class IReordered(Interface):
+            two = schema.Int(title=u"B")
+            one = schema.TextLine(title=u"A")
+
+        changes = utils.syncSchema(ISource, IDest, overwrite=True, diff=True)
+        changes = utils.syncSchema(IReordered, IDest, overwrite=True,
+                                   diff=True)
+        self.assertEqual([], changes['changed'])
+        self.assertEqual(['two'], changes['moved'])
+        self.assertEqual(['two', 'one'], getFieldNamesInOrder(IDest))
+
+        # Marker interfaces are compared, too
+        class IMarker(Interface):
+            pass
+
+        alsoProvides(IReordered['one'], IMarker)
+        changes = utils.syncSchema(IReordered, IDest, overwrite=True,
+                                   diff=True)
+        self.assertEqual(['one'], changes['changed'])
+        self.assertTrue(IMarker.providedBy(IDest['one']))
+
+    def test_syncSchema_diff_parsed(self):
+        from plone.supermodel import loadString
+        configure()
+        self.addCleanup(_clearContext)
+        self.addCleanup(zope.component.testing.tearDown, self)
+
+        class IDest(model.Schema):
+            pass
+
+        # Freshly parsed fields have new orders, which are not compared
+        utils.syncSchema(loadString(COMPILED_MODEL).schema, IDest,
+                         overwrite=True, diff=True)
+        fields = utils.sortedFields(IDest)
+        changes = utils.syncSchema(loadString(COMPILED_MODEL).schema, IDest,
+                                   overwrite=True, diff=True)
+        self.assertEqual([], changes['changed'])
+        self.assertEqual([], changes['moved'])
+        self.assertEqual([], changes['taggedValues'])
+        self.assertTrue(all(a[1] is b[1] for a, b in
+                            zip(fields, utils.sortedFields(IDest))))
+
+        # A changed field keeps its place
+        changes = utils.syncSchema(
+            loadString(COMPILED_MODEL.replace(u"<element>b</element>",
+                                              u"")).schema,
+            IDest, overwrite=True, diff=True)
+        self.assertEqual(['choice'], changes['changed'])
+        self.assertEqual([], changes['moved'])
+        self.assertEqual(['choice', 'items'],
+                         [name for name, field in utils.sortedFields(IDest)])
+
+    def test_syncSchema_diff_edit(self):
+        from plone.supermodel import loadString
+        configure()
+        self.addCleanup(_clearContext)
+        self.addCleanup(zope.component.testing.tearDown, self)
+
+        def xml(*fields):
+            return (
+                u'<model xmlns="http://namespaces.plone.org/supermodel/schema">'
+                u'<schema>%s</schema></model>' % u''.join(
+                    u'<field name="%s" type="zope.schema.TextLine">'
+                    u'<title>%s</title></field>' % field for field in fields)
+            )
+
+        class IDest(model.Schema):
+            pass
+
+        fields = [(u"f%d" % i, u"F%d" % i) for i in range(6)]
+        utils.syncSchema(loadString(xml(*fields)).schema, IDest,
+                         overwrite=True, diff=True)
+        before = dict(utils.sortedFields(IDest))
+
+        # Editing the first field only copies that one
+        fields[0] = (u"f0", u"Edited")
+        changes = utils.syncSchema(loadString(xml(*fields)).schema, IDest,
+                                   overwrite=True, diff=True)
+        self.assertEqual([u"f0"], changes['changed'])
+        self.assertEqual([], changes['moved'])
+        self.assertTrue(all(IDest[name] is before[name]
+                            for name, title in fields[1:]))
+
+        # Parsed fields have consecutive orders, so inserting a field moves
+        # the ones after it
+        fields.insert(3, (u"new", u"New"))
+        changes = utils.syncSchema(loadString(xml(*fields)).schema, IDest,
+                                   overwrite=True, diff=True)
+        self.assertEqual([u"new"], changes['added'])
+        self.assertEqual([], changes['changed'])
+        self.assertEqual([u"f3", u"f4", u"f5"], changes['moved'])
+        self.assertEqual([name for name, title in fields],
+                         getFieldNamesInOrder(IDest))
+
+        # Moving a field only copies that one
+        fields.append(fields.pop(1))
+        changes = utils.syncSchema(loadString(xml(*fields)).schema, IDest,
+                                   overwrite=True, diff=True)
+        self.assertEqual([], changes['changed'])
+        self.assertEqual([u"f1"], changes['moved'])
+        self.assertEqual([name for name, title in fields],
+                         getFieldNamesInOrder(IDest))
+
     def test_mergedTaggedValueList(self):
 
         class IBase1(Interface):
@@ -374,6 +535,105 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual({1: 1, 2: 1, 3: 3, 4: 4, 5: 4}, utils.mergedTaggedValueDict(ISchema, u"foo"))
 
+    def test_fieldTypecast(self):
+        self.assertEqual(12, utils.fieldTypecast(schema.Int(), u"12"))
+        self.assertEqual(u"abc", utils.fieldTypecast(schema.Int(), u"abc"))
+        self.assertEqual(u"abc", utils.fieldTypecast(schema.TextLine(), u"abc"))
+        self.assertEqual((1, 2), utils.fieldTypecast(schema.Tuple(), [1, 2]))
+        self.assertEqual(u"x", utils.fieldTypecast(schema.Field(), u"x"))
+
+        value = [1]
+        self.assertFalse(value is utils.fieldTypecast(schema.List(), value))
+
+        field = schema.Field()
+        field._type = (float, int)
+        self.assertTrue(isinstance(utils.fieldTypecast(field, u"2"), int))
+        self.assertEqual(1.5, utils.fieldTypecast(field, u"1.5"))
+        self.assertEqual(u"x", utils.fieldTypecast(field, u"x"))
+        field._type = [int, float]
+        self.assertTrue(isinstance(utils.fieldTypecast(field, u"2"), float))
+
+    def test_sortedFields_cached(self):
+
+        class ISource(model.Schema):
+            one = schema.TextLine(title=u"A")
+            two = schema.Int(title=u"B")
+
+        class IDest(model.Schema):
+            three = schema.Int(title=u"C")
+
+        fields = utils.sortedFields(IDest)
+        self.assertEqual(['three'], [name for name, field in fields])
+        fields.append(None)
+        self.assertEqual(['three'], [name for name, field in utils.sortedFields(IDest)])
+
+        utils.syncSchema(ISource, IDest, overwrite=True)
+        self.assertEqual(['one', 'two'], [name for name, field in utils.sortedFields(IDest)])
+
+        # Fields replaced in place are noticed, too
+        before = IDest['one']
+        utils.syncSchema(ISource, IDest, overwrite=True)
+        self.assertFalse(IDest['one'] is before)
+        self.assertTrue(IDest['one'] is utils.sortedFields(IDest)[0][1])
+
+        # Without invalidateSortedFields(), as done by plone.schemaeditor
+        attrs = IDest._InterfaceClass__attrs
+        one, two = IDest['one'], IDest['two']
+        one.order, two.order = two.order, one.order
+        self.assertEqual(['two', 'one'], [name for name, field in utils.sortedFields(IDest)])
+
+        replacement = schema.TextLine(title=u"D")
+        replacement.order = one.order
+        attrs['one'] = replacement
+        self.assertTrue(replacement is dict(utils.sortedFields(IDest))['one'])
+
+    def test_cachedMergedTaggedValues(self):
+
+        class IPlain(Interface):
+            pass
+
+        class IBase(model.Schema):
+            pass
+
+        class ISchema(IBase, IPlain):
+            pass
+
+        IPlain.setTaggedValue(u"foo", {1: 1, 2: 1})
+        IBase.setTaggedValue(u"foo", {2: 2})
+        IBase.setTaggedValue(u"bar", [1])
+        ISchema.setTaggedValue(u"bar", [2])
+
+        merged = utils.cachedMergedTaggedValueDict(ISchema, u"foo")
+        self.assertEqual({1: 1, 2: 2}, dict(merged))
+        if sys.version_info >= (3,):
+            self.assertTrue(merged is utils.cachedMergedTaggedValueDict(ISchema, u"foo"))
+            with self.assertRaises(TypeError):
+                merged[3] = 3
+        self.assertEqual((1, 2), utils.cachedMergedTaggedValueList(ISchema, u"bar"))
+
+        # Unrelated schemata do not invalidate the cache
+        class IOther(model.Schema):
+            pass
+
+        IOther.setTaggedValue(u"foo", {5: 5})
+        generation = model.taggedValuesGeneration(ISchema)
+        if sys.version_info >= (3,):
+            self.assertTrue(merged is utils.cachedMergedTaggedValueDict(ISchema, u"foo"))
+        self.assertEqual(generation, model.taggedValuesGeneration(ISchema))
+
+        # Setting a tagged value on a schema or a plain interface
+        # invalidates the cache
+        IBase.setTaggedValue(u"foo", {2: 3})
+        self.assertEqual({1: 1, 2: 3}, dict(utils.cachedMergedTaggedValueDict(ISchema, u"foo")))
+        IPlain.setTaggedValue(u"foo", {4: 4})
+        self.assertEqual({2: 3, 4: 4}, dict(utils.cachedMergedTaggedValueDict(ISchema, u"foo")))
+
+        # So does changing the bases
+        ISchema.__bases__ = (IBase, )
+        self.assertEqual({2: 3}, dict(utils.cachedMergedTaggedValueDict(ISchema, u"foo")))
+        ISchema.__bases__ = (model.Schema, )
+        self.assertEqual((2, ), utils.cachedMergedTaggedValueList(ISchema, u"bar"))
+
 
 class TestValueToElement(unittest.TestCase):
 
@@ -447,6 +707,181 @@ class TestValueToElement(unittest.TestCase):
             b'</value>'
             )
 
+    def test_converter(self):
+
+        class Converter(object):
+            calls = 0
+
+            def fromUnicode(self, value):
+                self.calls += 1
+                return value.upper()
+
+            def toUnicode(self, value):
+                self.calls += 1
+                return value.lower()
+
+        converter = Converter()
+        field = schema.TextLine()
+        element = utils.valueToElement(field, u"ABC", 'value',
+                                       converter=converter)
+        self.assertEqual(u"abc", element.text)
+        self.assertEqual(u"ABC", utils.elementToValue(field, element,
+                                                     converter=converter))
+        self.assertEqual(2, converter.calls)
+
+    def test_list_converter_lookup(self):
+        from plone.supermodel.interfaces import IToUnicode
+        from zope.component import getSiteManager
+        from zope.schema.interfaces import IInt
+        converters = []
+        factory = getSiteManager().adapters.lookup((IInt, ), IToUnicode)
+
+        def countingFactory(field):
+            converters.append(field)
+            return factory(field)
+
+        getSiteManager().registerAdapter(countingFactory, (IInt, ), IToUnicode)
+        field = schema.List(value_type=schema.Int())
+        self._assertSerialized(field, [1, 2, 3],
+            b'<value>'
+            b'<element>1</element>'
+            b'<element>2</element>'
+            b'<element>3</element>'
+            b'</value>'
+            )
+        self.assertEqual(1, len(converters))
+
+
+class TestDateConverters(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def _roundtrip(self, field, value):
+        from plone.supermodel.interfaces import IToUnicode
+        from zope.schema.interfaces import IFromUnicode
+        text = IToUnicode(field).toUnicode(value)
+        return text, IFromUnicode(field).fromUnicode(text)
+
+    def test_date(self):
+        import datetime
+        from zope.schema.interfaces import IFromUnicode
+        field = schema.Date()
+        self.assertEqual((u"2016-02-29", datetime.date(2016, 2, 29)),
+                         self._roundtrip(field, datetime.date(2016, 2, 29)))
+        self.assertRaises(ValueError, IFromUnicode(field).fromUnicode,
+                          u"29.02.2016")
+
+    def test_datetime(self):
+        import datetime
+        from zope.schema.interfaces import IFromUnicode
+        field = schema.Datetime()
+        value = datetime.datetime(2016, 2, 29, 12, 30, 15)
+        self.assertEqual((u"2016-02-29 12:30:15", value),
+                         self._roundtrip(field, value))
+        self.assertEqual(value, IFromUnicode(field).fromUnicode(
+            u"2016-02-29 12:30:15"))
+
+        if sys.version_info >= (3, 7):
+            value = datetime.datetime(
+                2016, 2, 29, 12, 30, 15, 250,
+                tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+            )
+            self.assertEqual((u"2016-02-29 12:30:15.000250+02:00", value),
+                             self._roundtrip(field, value))
+
+
+class TestFieldHandler(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_read_skips_filtered_and_unknown_elements(self):
+        from plone.supermodel.debug import parseinfo
+        from plone.supermodel.exportimport import BaseHandler
+        handler = BaseHandler(schema.Int)
+        element = etree.fromstring(
+            b'<field name="number" type="zope.schema.Int"'
+            b' xmlns="http://namespaces.plone.org/supermodel/schema">'
+            b'<order>5</order>'
+            b'<unknown>x</unknown>'
+            b'<title>Number</title>'
+            b'<min>1</min>'
+            b'<default>2</default>'
+            b'<missing_value>0</missing_value>'
+            b'</field>'
+        )
+        stack = list(parseinfo.stack)
+        for i in range(2):
+            field = handler.read(element)
+            self.assertEqual(stack, parseinfo.stack)
+            self.assertEqual(u"Number", field.title)
+            self.assertEqual((1, 2, 0),
+                             (field.min, field.default, field.missing_value))
+            self.assertNotEqual(5, field.order)
+
+    def test_read_invalid_missing_value(self):
+        from plone.supermodel.exportimport import BaseHandler
+        from zope.schema.interfaces import TooSmall
+        handler = BaseHandler(schema.Int)
+        element = etree.fromstring(
+            b'<field name="number" type="zope.schema.Int">'
+            b'<min>1</min>'
+            b'<missing_value>0</missing_value>'
+            b'</field>'
+        )
+        field = handler.read(element)
+        self.assertEqual(0, field.missing_value)
+        # Validation is only suppressed while missing_value is read
+        self.assertFalse('validate' in field.__dict__)
+        self.assertRaises(TooSmall, field.validate, -1)
+
+    def test_write(self):
+        from plone.supermodel.exportimport import BaseHandler
+        handler = BaseHandler(schema.List)
+        field = schema.List(__name__='numbers', title=u"Numbers",
+                            value_type=schema.Int(min=1), default=[1])
+        expected = (
+            b'<field name="numbers" type="zope.schema.List">'
+            b'<default><element>1</element></default>'
+            b'<title>Numbers</title>'
+            b'<value_type type="zope.schema.Int"><min>1</min></value_type>'
+            b'</field>'
+        )
+        for i in range(2):
+            element = handler.write(field, 'numbers', 'zope.schema.List')
+            self.assertEqual(expected, etree.tostring(element))
+
+    def test_fieldTypeName(self):
+        from plone.supermodel.interfaces import IFieldNameExtractor
+        from plone.supermodel.registry import fieldTypeName
+        from zope.component import adapter
+        from zope.component import provideAdapter
+        from zope.schema.interfaces import IInt
+        field = schema.Int()
+        self.assertEqual('zope.schema.Int', fieldTypeName(field))
+
+        @implementer(IFieldNameExtractor)
+        @adapter(IInt)
+        class Extractor(object):
+
+            def __init__(self, context):
+                pass
+
+            def __call__(self):
+                return 'custom.Int'
+
+        provideAdapter(Extractor)
+        self.assertEqual('custom.Int', fieldTypeName(field))
+
 
 class TestChoiceHandling(unittest.TestCase):
 
@@ -573,6 +1008,1068 @@ class TestSchemaDirectives(unittest.TestCase):
         )
 
 
+MODEL = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<model xmlns="http://namespaces.plone.org/supermodel/schema">
+    <schema>
+        <field type="zope.schema.TextLine" name="%s">
+            <title>Title</title>
+        </field>
+    </schema>
+</model>
+"""
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = cache.ModelCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def _write(self, name, fieldName, mtime=None):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(MODEL % fieldName)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def _load(self, filename):
+        from plone.supermodel import parser
+        return self.cache.load(filename, parser.parse)
+
+    def test_hit(self):
+        filename = self._write('a.xml', 'title')
+        model = self._load(filename)
+        self.assertTrue(self._load(filename) is model)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_changed_file_is_reparsed(self):
+        filename = self._write('a.xml', 'title', mtime=1000000)
+        model = self._load(filename)
+        self._write('a.xml', 'other', mtime=2000000)
+        reloaded = self._load(filename)
+        self.assertFalse(reloaded is model)
+        self.assertEqual(['other'], list(reloaded.schema))
+
+    def test_touched_file_is_not_reparsed(self):
+        filename = self._write('a.xml', 'title', mtime=1000000)
+        model = self._load(filename)
+        self._write('a.xml', 'title', mtime=2000000)
+        self.assertTrue(self._load(filename) is model)
+
+    def test_evict_by_entries(self):
+        self.cache.maxEntries = 2
+        a = self._write('a.xml', 'a')
+        b = self._write('b.xml', 'b')
+        c = self._write('c.xml', 'c')
+        self._load(a)
+        self._load(b)
+        self._load(a)
+        self._load(c)
+        self.assertTrue(a in self.cache)
+        self.assertFalse(b in self.cache)
+        self.assertTrue(c in self.cache)
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_evict_by_bytes(self):
+        a = self._write('a.xml', 'a')
+        self.cache.maxBytes = os.path.getsize(a) + 1
+        b = self._write('b.xml', 'b')
+        self._load(a)
+        self._load(b)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(os.path.getsize(b), self.cache.stats()['bytes'])
+
+    def test_single_flight(self):
+        import threading
+        import time
+        from plone.supermodel import parser
+        filename = self._write('a.xml', 'title')
+        calls = []
+
+        def loader(path):
+            calls.append(path)
+            time.sleep(0.1)
+            return parser.parse(path)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.load(filename, loader)
+                )
+            )
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(model is results[0] for model in results))
+
+    def test_invalidate(self):
+        a = self._write('a.xml', 'a')
+        b = self._write('b.xml', 'b')
+        model = self._load(a)
+        self._load(b)
+        self.cache.invalidate(a)
+        self.assertFalse(a in self.cache)
+        self.assertTrue(b in self.cache)
+        self.assertFalse(self._load(a) is model)
+        self.cache.invalidate()
+        self.assertEqual(0, len(self.cache))
+
+
+class TestStringCache(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        from plone.supermodel import _string_cache
+        _string_cache.invalidate()
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_cached(self):
+        from plone.supermodel import loadString
+        first = loadString(MODEL % 'title', cached=True)
+        second = loadString(MODEL % 'title', cached=True)
+        self.assertFalse(first is second)
+        self.assertFalse(first.schemata is second.schemata)
+        self.assertTrue(first.schema is second.schema)
+
+        other = loadString(MODEL % 'other', cached=True)
+        self.assertEqual(['other'], list(other.schema))
+
+    def test_not_cached_by_default(self):
+        from plone.supermodel import loadString
+        first = loadString(MODEL % 'title')
+        second = loadString(MODEL % 'title', cached=True)
+        self.assertFalse(first.schema is second.schema)
+
+
+COMPILED_MODEL = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<model xmlns="http://namespaces.plone.org/supermodel/schema"
+       xmlns:security="http://namespaces.plone.org/supermodel/security"
+       xmlns:i18n="http://xml.zope.org/namespaces/i18n"
+       i18n:domain="plone.supermodel.tests">
+    <schema based-on="plone.supermodel.tests.IBase">
+        <invariant>plone.supermodel.tests.dummy_invariant</invariant>
+        <field type="zope.schema.Choice" name="choice"
+               security:read-permission="zope2.View">
+            <title i18n:translate="">Choice</title>
+            <values>
+                <element>a</element>
+                <element>b</element>
+            </values>
+        </field>
+        <fieldset name="extra" label="Extra">
+            <field type="zope.schema.List" name="items">
+                <value_type type="zope.schema.Int" />
+                <default>
+                    <element>1</element>
+                </default>
+            </field>
+        </fieldset>
+    </schema>
+</model>
+"""
+
+
+class TestCompiledModels(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        from zope.component import provideUtility
+        from plone.supermodel.interfaces import IFieldMetadataHandler
+        from plone.supermodel.security import SecuritySchema
+        provideUtility(SecuritySchema(), IFieldMetadataHandler,
+                       name=u"plone.supermodel.security")
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'model.xml')
+        with open(self.filename, 'w') as f:
+            f.write(COMPILED_MODEL)
+        compiled.setCacheDirectory(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        compiled.setCacheDirectory(None)
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def _digest(self):
+        with open(self.filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def test_round_trip(self):
+        from plone.supermodel import serializeModel
+        from plone.supermodel.interfaces import FIELDSETS_KEY
+        parsed = compiled.parseFile(self.filename)
+        loaded = compiled._store.load(self.filename, u"", self._digest())
+        self.assertFalse(loaded is None)
+        self.assertFalse(loaded.schema is parsed.schema)
+        self.assertTrue(loaded.schema['choice'].interface is loaded.schema)
+        self.assertEqual(['extra'], [fs.__name__ for fs in
+                         loaded.schema.getTaggedValue(FIELDSETS_KEY)])
+        self.assertEqual(
+            {'choice': 'zope2.View'},
+            loaded.schema.getTaggedValue(READ_PERMISSIONS_KEY))
+        self.assertEqual(serializeModel(parsed), serializeModel(loaded))
+
+    def test_inherited_tagged_values(self):
+        from plone.supermodel.fingerprint import schemaFingerprint
+        with open(self.filename, 'w') as f:
+            f.write(COMPILED_MODEL.replace(
+                u"plone.supermodel.tests.IBase",
+                u"plone.supermodel.tests.IBase "
+                u"plone.supermodel.tests.ITaggedBase"))
+        parsed = compiled.parseFile(self.filename)
+        loaded = compiled._store.load(self.filename, u"", self._digest())
+        self.assertEqual(
+            sorted(parsed.schema.getDirectTaggedValueTags()),
+            sorted(loaded.schema.getDirectTaggedValueTags()))
+        self.assertFalse(u"plone.supermodel.tests.base" in
+                         loaded.schema.getDirectTaggedValueTags())
+        self.assertEqual(u"base", loaded.schema.getTaggedValue(
+            u"plone.supermodel.tests.base"))
+        self.assertEqual(schemaFingerprint(parsed.schema),
+                         schemaFingerprint(loaded.schema))
+
+    def test_unwritable_directory(self):
+        # The cache directory cannot be created below a file
+        compiled.setCacheDirectory(os.path.join(self.filename, 'cache'))
+        model = compiled.parseFile(self.filename)
+        self.assertEqual(['choice', 'items'], sorted(model.schema.names()))
+
+    def test_version(self):
+        self.assertFalse(compiled.VERSION is None)
+
+    def test_tampered(self):
+        compiled.parseFile(self.filename)
+        filename = compiled._store._filename(self.filename, u"")
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write(data.replace(b'zope2.View', b'zope2.Edit'))
+        self.assertEqual(
+            None, compiled._store.load(self.filename, u"", self._digest()))
+
+    def test_untrusted_directory(self):
+        if not hasattr(os, 'getuid'):
+            return
+        compiled.parseFile(self.filename)
+        directory = compiled._store.directory
+        os.chmod(directory, 0o777)
+        self.assertEqual(
+            None, compiled._store.load(self.filename, u"", self._digest()))
+        os.chmod(directory, 0o700)
+        self.assertFalse(compiled._store.load(
+            self.filename, u"", self._digest()) is None)
+
+        filename = compiled._store._filename(self.filename, u"")
+        os.chmod(filename, 0o666)
+        self.assertEqual(
+            None, compiled._store.load(self.filename, u"", self._digest()))
+
+    def test_stale(self):
+        compiled.parseFile(self.filename)
+        self.assertEqual(
+            None, compiled._store.load(self.filename, u"", 'other digest'))
+        self.assertEqual(
+            None, compiled._store.load(self.filename, u"other policy",
+                                       self._digest()))
+
+
+class TestHandlerTable(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_reused_until_registrations_change(self):
+        from plone.supermodel.interfaces import IFieldMetadataHandler
+        from plone.supermodel.registry import getHandlerTable
+        from plone.supermodel.security import SecuritySchema
+        from zope.component import provideUtility
+
+        table = getHandlerTable()
+        handler = table.fieldHandler('zope.schema.TextLine')
+        self.assertTrue(getHandlerTable() is table)
+        self.assertTrue(table.fieldHandler('zope.schema.TextLine') is handler)
+        self.assertEqual(None, table.fieldHandler('unknown'))
+        self.assertEqual((), table.fieldMetadataHandlers)
+
+        metadata_handler = SecuritySchema()
+        provideUtility(metadata_handler, IFieldMetadataHandler,
+                       name=u"plone.supermodel.security")
+        table = getHandlerTable()
+        self.assertEqual(((u"plone.supermodel.security", metadata_handler),),
+                         table.fieldMetadataHandlers)
+
+
+class TestIterparse(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_iterparse(self):
+        from plone.supermodel import parser
+        source = BytesIO(b"""\
+<model xmlns="http://namespaces.plone.org/supermodel/schema"
+       xmlns:i18n="http://xml.zope.org/namespaces/i18n"
+       i18n:domain="plone.supermodel.tests">
+    <schema>
+        <field type="zope.schema.TextLine" name="title">
+            <title i18n:translate="">Title</title>
+        </field>
+    </schema>
+    <schema name="other">
+        <fieldset name="extra">
+            <field type="zope.schema.Int" name="count">
+                <title>Count</title>
+            </field>
+        </fieldset>
+    </schema>
+</model>
+""")
+        items = parser.iterparse(source)
+        schemaName, schema = next(items)
+        self.assertEqual(u"", schemaName)
+        self.assertEqual(['title'], getFieldNamesInOrder(schema))
+        self.assertEqual('plone.supermodel.tests', schema['title'].title.domain)
+
+        schemaName, schema = next(items)
+        self.assertEqual(u"other", schemaName)
+        self.assertEqual(['count'], getFieldNamesInOrder(schema))
+        self.assertRaises(StopIteration, next, items)
+
+    def test_iterparse_error(self):
+        from plone.supermodel import parser
+        source = BytesIO(b"""\
+<model xmlns="http://namespaces.plone.org/supermodel/schema">
+    <schema>
+        <field type="zope.schema.TextLine" name="title" />
+    </schema>
+    <schema name="broken">
+        <field type="aint_gonna_exist" name="title" />
+    </schema>
+</model>
+""")
+        items = parser.iterparse(source)
+        next(items)
+        self.assertRaises(parser.SupermodelParseError, next, items)
+
+
+class TestLoadFiles(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        from plone.supermodel import invalidateFile
+        invalidateFile()
+        # Schemata loaded from the files would be reloaded if they are
+        # finalized again, so make sure they are gone with the files.
+        gc.collect()
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def _write(self, name, content):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+    def test_loadFiles(self):
+        from plone.supermodel import loadFile
+        from plone.supermodel import loadFiles
+        from plone.supermodel.interfaces import FILENAME_KEY
+        a = self._write('a.xml', MODEL % 'a')
+        b = self._write('b.xml', MODEL % 'b')
+        c = self._write('c.xml', MODEL % 'c')
+        cached = loadFile(c)
+
+        models = loadFiles([a, b, c, a], workers=2)
+        self.assertEqual([['a'], ['b'], ['c'], ['a']],
+                         [list(m.schema) for m in models])
+        self.assertTrue(models[0] is models[3])
+        self.assertTrue(models[2] is cached)
+        self.assertTrue(loadFile(a) is models[0])
+        self.assertEqual(b, models[1].schema.getTaggedValue(FILENAME_KEY))
+
+    def test_loadFiles_error(self):
+        from plone.supermodel import loadFiles
+        from plone.supermodel.parser import SupermodelParseError
+        a = self._write('a.xml', MODEL % 'a')
+        b = self._write('b.xml', '<model')
+        self.assertRaises(SupermodelParseError, loadFiles, [a, b], workers=2)
+
+
+class TestSerializerModes(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_modes(self):
+        from plone.supermodel import loadString
+        from plone.supermodel import serializeModel
+        from plone.supermodel import serializer
+        model = loadString(COMPILED_MODEL)
+        compat = serializeModel(model)
+        self.assertEqual(compat,
+                         serializeModel(model, mode=serializer.COMPAT))
+        self.assertEqual(compat,
+                         serializeModel(model, mode=serializer.PRETTY))
+
+        compact = serializeModel(model, mode=serializer.COMPACT)
+        self.assertFalse(b'\n' in compact)
+        self.assertEqual(compat, serializeModel(loadString(compact)))
+
+    def test_i18n_written_by_handlers(self):
+        # Handlers which write i18n attributes themselves get the same
+        # output as when the whole tree was searched for them
+        from plone.supermodel import serializeModel
+        from plone.supermodel import serializer
+        from plone.supermodel.interfaces import I18N_NAMESPACE
+        from plone.supermodel.interfaces import IFieldMetadataHandler
+        from plone.supermodel.utils import ns
+        from zope.component import provideUtility
+        from zope.i18nmessageid import MessageFactory
+
+        @implementer(IFieldMetadataHandler)
+        class HelpHandler(object):
+            namespace = None
+            prefix = None
+
+            def read(self, fieldNode, schema, field):
+                pass
+
+            def write(self, fieldNode, schema, field):
+                help = etree.SubElement(fieldNode, 'help')
+                help.set(ns('domain', I18N_NAMESPACE),
+                         field.__name__ == 'one' and u"tests" or u"other")
+                help.set(ns('translate', I18N_NAMESPACE), u"")
+                help.text = u"Help"
+
+        provideUtility(HelpHandler(), IFieldMetadataHandler,
+                       name=u"plone.supermodel.tests.help")
+
+        class ISchema(model.Schema):
+            one = schema.TextLine()
+            two = schema.TextLine(title=MessageFactory('tests')(u"Two"))
+
+        self.assertEqual(
+            b'<model xmlns:i18n="http://xml.zope.org/namespaces/i18n" '
+            b'xmlns="http://namespaces.plone.org/supermodel/schema" '
+            b'i18n:domain="tests"><schema>'
+            b'<field name="one" type="zope.schema.TextLine">'
+            b'<help i18n:translate="">Help</help></field>'
+            b'<field name="two" type="zope.schema.TextLine">'
+            b'<title i18n:translate="">Two</title>'
+            b'<help i18n:domain="other" i18n:translate="">Help</help>'
+            b'</field></schema></model>',
+            serializeModel(model.Model({u"": ISchema}),
+                           mode=serializer.COMPACT))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_generateModel(self):
+        from plone.supermodel import benchmark
+        from plone.supermodel import loadString
+        from plone.supermodel.interfaces import FIELDSETS_KEY
+        model = loadString(benchmark.generateModel(
+            schemata=2, fields=7, fieldsets=2, nested=True, security=True
+        ))
+        self.assertEqual(2, len(model.schemata))
+        schema = model.schemata['schema_1']
+        self.assertEqual(7, len(schema.names()))
+        self.assertEqual(2, len(schema.getTaggedValue(FIELDSETS_KEY)))
+
+    def test_run(self):
+        from plone.supermodel import benchmark
+        results = benchmark.run((('tiny', dict(fields=2)), ), repeat=1)
+        self.assertEqual(sorted(benchmark.PHASES), sorted(results['tiny']))
+
+    def test_measure_setup(self):
+        from plone.supermodel import benchmark
+        calls = []
+        benchmark.measure(lambda: calls.append('func'), 2,
+                          setup=lambda: calls.append('setup'))
+        self.assertEqual(['setup', 'func'], calls[:2])
+        self.assertEqual(calls.count('setup'), calls.count('func'))
+
+    def test_finalize_runs_plugins(self):
+        from plone.supermodel import benchmark
+        from plone.supermodel.model import Schema
+        from plone.supermodel.model import finalizeSchemas
+        from plone.supermodel.model import _finalizedSchemas
+        finalizeSchemas(Schema)
+        self.assertTrue(Schema._SchemaClass_isFinalized())
+        benchmark._clearFinalized()
+        self.assertFalse(Schema._SchemaClass_isFinalized())
+        self.assertEqual({}, _finalizedSchemas())
+
+
+class TestFinalizeSchemas(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        from plone.supermodel.interfaces import ISchema
+        from plone.supermodel.interfaces import ISchemaPlugin
+        from zope.component import adapter
+        from zope.component import provideAdapter
+
+        self.calls = calls = []
+
+        @adapter(ISchema)
+        @implementer(ISchemaPlugin)
+        class CountingPlugin(object):
+
+            def __init__(self, schema):
+                self.schema = schema
+
+            def __call__(self):
+                calls.append(self.schema)
+
+        self.plugin = CountingPlugin
+        provideAdapter(CountingPlugin, name=u"plone.supermodel.tests.count")
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_finalize_diamond_once(self):
+
+        class IA(model.Schema):
+            pass
+
+        class IB(IA):
+            pass
+
+        class IC(IA):
+            pass
+
+        class ID(IB, IC):
+            pass
+
+        self.assertEqual([IA, IB, IC, ID], self.calls)
+
+        # Nothing changed since the schemata were created
+        del self.calls[:]
+        model.finalizeSchemas(IA)
+        self.assertEqual([], self.calls)
+
+        # A new registration means everything has to be finalized again,
+        # but only once
+        from zope.component import provideAdapter
+        provideAdapter(self.plugin, name=u"plone.supermodel.tests.count2")
+        model.finalizeSchemas(IA)
+        self.assertEqual(2, self.calls.count(ID))
+        self.assertEqual(set([IA, IB, IC, ID]), set(self.calls))
+
+    def test_plugin_order(self):
+        from plone.supermodel.interfaces import ISchema
+        from plone.supermodel.interfaces import ISchemaPlugin
+        from zope.component import adapter
+        from zope.component import provideAdapter
+        calls = self.calls
+
+        @adapter(ISchema)
+        @implementer(ISchemaPlugin)
+        class EarlyPlugin(object):
+            order = -1
+
+            def __init__(self, schema):
+                self.schema = schema
+
+            def __call__(self):
+                calls.append('early')
+
+        @adapter(ISchema)
+        def skippedPlugin(schema):
+            return None
+
+        provideAdapter(EarlyPlugin, provides=ISchemaPlugin,
+                       name=u"plone.supermodel.tests.early")
+        provideAdapter(skippedPlugin, provides=ISchemaPlugin,
+                       name=u"plone.supermodel.tests.skipped")
+
+        class IA(model.Schema):
+            pass
+
+        self.assertEqual(['early', IA], calls)
+
+        # The cached plugins are used for the next schema
+        class IB(model.Schema):
+            pass
+
+        self.assertEqual(['early', IA, 'early', IB], calls)
+        self.assertEqual(
+            [u"plone.supermodel.tests.early",
+             u"plone.supermodel.tests.count",
+             u"plone.supermodel.tests.skipped"],
+            [name for name, factory in model._schemaPlugins(IB)
+             if name.startswith(u"plone.supermodel.tests.")]
+        )
+
+    def test_plugin_taggedValues(self):
+        from plone.supermodel.directives import FieldsetCheckerPlugin
+        from plone.supermodel.directives import SupermodelSchemaPlugin
+        from plone.supermodel.interfaces import FIELDSETS_KEY
+        from plone.supermodel.interfaces import FILENAME_KEY
+        from zope.component import provideAdapter
+        self.assertEqual((FIELDSETS_KEY, ), FieldsetCheckerPlugin.taggedValues)
+        self.assertEqual((FILENAME_KEY, ), SupermodelSchemaPlugin.taggedValues)
+
+        self.plugin.taggedValues = (u"plone.supermodel.tests.tag", )
+        provideAdapter(self.plugin, name=u"plone.supermodel.tests.count")
+
+        class IA(model.Schema):
+            pass
+
+        self.assertEqual([], self.calls)
+
+        class IB(model.Schema):
+            pass
+
+        IB.setTaggedValue(u"plone.supermodel.tests.tag", True)
+        model.finalizeSchemas(IB)
+        self.assertEqual([], self.calls)
+
+        # Inherited tagged values count too
+        class IC(IB):
+            pass
+
+        self.assertEqual([IC], self.calls)
+
+
+LAZY_MODEL = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<model xmlns="http://namespaces.plone.org/supermodel/schema"
+       xmlns:i18n="http://xml.zope.org/namespaces/i18n"
+       i18n:domain="plone.supermodel.tests">
+    <schema>
+        <field type="zope.schema.TextLine" name="title">
+            <title i18n:translate="">Title</title>
+        </field>
+    </schema>
+    <schema name="broken">
+        <field type="zope.schema.Unknown" name="unknown" />
+    </schema>
+    <schema name="other">
+        <field type="zope.schema.Int" name="number" />
+    </schema>
+</model>
+"""
+
+
+class TestLazyModel(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        from plone.supermodel import invalidateFile
+        invalidateFile()
+        gc.collect()
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_parse_lazy(self):
+        from io import BytesIO
+        from plone.supermodel import parser
+        model = parser.parse(BytesIO(LAZY_MODEL.encode('utf-8')), lazy=True)
+        schemata = model.schemata
+        self.assertEqual([u"", u"broken", u"other"], list(schemata))
+        self.assertTrue(u"other" in schemata)
+        self.assertFalse(schemata.isLoaded(u"other"))
+
+        self.assertEqual(['number'], list(schemata[u"other"]))
+        self.assertTrue(schemata.isLoaded(u"other"))
+        self.assertTrue(schemata[u"other"] is schemata[u"other"])
+        self.assertEqual(u"plone.supermodel.tests",
+                         model.schema['title'].title.domain)
+
+        # Errors are only reported when the schema is used
+        self.assertRaises(parser.SupermodelParseError,
+                          schemata.__getitem__, u"broken")
+        self.assertRaises(KeyError, schemata.__getitem__, u"missing")
+
+        del schemata[u"broken"]
+        schemata[u"new"] = schemata[u"other"]
+        self.assertEqual([u"", u"other", u"new"], list(schemata))
+
+    def test_loadFile_lazy(self):
+        from plone.supermodel import loadFile
+        from plone.supermodel import xmlSchema
+        from plone.supermodel.interfaces import FILENAME_KEY
+        filename = os.path.join(self.tmpdir, 'model.xml')
+        with open(filename, 'w') as f:
+            f.write(LAZY_MODEL.replace(
+                u'type="zope.schema.Unknown"', u'type="zope.schema.Int"'))
+
+        schema = xmlSchema(filename, schema=u"other", lazy=True)
+        self.assertEqual(filename, schema.getTaggedValue(FILENAME_KEY))
+        model = loadFile(filename, lazy=True)
+        self.assertTrue(model.schemata[u"other"] is schema)
+        self.assertFalse(model.schemata.isLoaded(u""))
+
+        # Eager callers get the cached model with all schemata constructed
+        model = loadFile(filename)
+        self.assertTrue(model.schemata[u"other"] is schema)
+        self.assertTrue(model.schemata.isLoaded(u""))
+        self.assertTrue(model.schemata.isLoaded(u"broken"))
+        self.assertEqual(filename,
+                         model.schema.getTaggedValue(FILENAME_KEY))
+
+    def test_loadFile_lazy_then_eager_errors(self):
+        from plone.supermodel import loadFile
+        from plone.supermodel import xmlSchema
+        from plone.supermodel.parser import SupermodelParseError
+        filename = os.path.join(self.tmpdir, 'model.xml')
+        with open(filename, 'w') as f:
+            f.write(LAZY_MODEL)
+
+        xmlSchema(filename, schema=u"other", lazy=True)
+        self.assertRaises(SupermodelParseError, loadFile, filename)
+        self.assertRaises(SupermodelParseError, xmlSchema, filename,
+                          schema=u"other")
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_fingerprints(self):
+        from plone.supermodel import loadString
+        from plone.supermodel.fingerprint import fieldFingerprint
+        from plone.supermodel.fingerprint import modelFingerprint
+        from plone.supermodel.fingerprint import schemaFingerprint
+        from plone.supermodel.interfaces import FILENAME_KEY
+        a = loadString(COMPILED_MODEL)
+        b = loadString(COMPILED_MODEL)
+        self.assertFalse(a.schema is b.schema)
+        self.assertEqual(modelFingerprint(a), modelFingerprint(b))
+        self.assertEqual(fieldFingerprint(a.schema['items']),
+                         fieldFingerprint(b.schema['items']))
+        self.assertNotEqual(fieldFingerprint(a.schema['items']),
+                            fieldFingerprint(a.schema['choice']))
+
+        a.schema.setTaggedValue(FILENAME_KEY, '/tmp/a.xml')
+        self.assertEqual(schemaFingerprint(a.schema),
+                         schemaFingerprint(b.schema))
+
+        a.schema['choice'].title = u"Changed"
+        self.assertNotEqual(schemaFingerprint(a.schema),
+                            schemaFingerprint(b.schema))
+        a.schema['choice'].title = b.schema['choice'].title
+        self.assertEqual(modelFingerprint(a), modelFingerprint(b))
+
+        a.schema.setTaggedValue('invariants', [])
+        self.assertNotEqual(modelFingerprint(a), modelFingerprint(b))
+        self.assertNotEqual(modelFingerprint(b),
+                            modelFingerprint(model.Model({u"other": b.schema})))
+
+    def test_fieldFingerprint_markers_and_tagged_values(self):
+        from plone.supermodel.fingerprint import fieldFingerprint
+        from zope.interface import noLongerProvides
+
+        class IMarker(Interface):
+            pass
+
+        field = schema.TextLine(title=u"A")
+        before = fieldFingerprint(field)
+        alsoProvides(field, IMarker)
+        marked = fieldFingerprint(field)
+        self.assertNotEqual(before, marked)
+        noLongerProvides(field, IMarker)
+        self.assertEqual(before, fieldFingerprint(field))
+
+        field.setTaggedValue(u"tag", 1)
+        first = fieldFingerprint(field)
+        self.assertNotEqual(before, first)
+        # The tagged values are changed in place the second time
+        field.setTaggedValue(u"tag", 2)
+        self.assertNotEqual(first, fieldFingerprint(field))
+        field.setTaggedValue(u"other", 1)
+        self.assertNotEqual(first, fieldFingerprint(field))
+
+
+class TestDiffModels(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        from plone.supermodel.interfaces import IFieldMetadataHandler
+        from plone.supermodel.security import SecuritySchema
+        from zope.component import provideUtility
+        provideUtility(SecuritySchema(), IFieldMetadataHandler,
+                       name=u"plone.supermodel.security")
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_diffModels(self):
+        from plone.supermodel import diffModels
+        from plone.supermodel import loadString
+        a = loadString(COMPILED_MODEL)
+        b = loadString(COMPILED_MODEL.replace(
+            u'<element>b</element>', u'<element>c</element>'
+        ).replace(
+            u'label="Extra"', u'label="More"'
+        ).replace(
+            u'security:read-permission="zope2.View"', u''
+        ).replace(
+            u'</schema>', u'</schema><schema name="new" />'
+        ))
+        self.assertEqual({'added': [], 'removed': [], 'changed': {}},
+                         diffModels(a, loadString(COMPILED_MODEL)))
+
+        diff = diffModels(a, b)
+        self.assertEqual(['new'], diff['added'])
+        self.assertEqual([], diff['removed'])
+        self.assertEqual([u""], list(diff['changed']))
+        schemaDiff = diff['changed'][u""]
+        self.assertEqual({'added': [], 'removed': [],
+                          'changed': {'choice': ['source', 'vocabulary']}},
+                         schemaDiff['fields'])
+        self.assertEqual({'added': [], 'removed': [], 'changed': ['extra']},
+                         schemaDiff['fieldsets'])
+        self.assertEqual([READ_PERMISSIONS_KEY], schemaDiff['metadata'])
+        self.assertFalse(schemaDiff['bases'])
+        self.assertFalse(schemaDiff['order'])
+
+    def test_diffSchemata_order(self):
+        from plone.supermodel.diff import diffSchemata
+
+        class IA(model.Schema):
+            one = schema.TextLine(title=u"A")
+            two = schema.Int(title=u"B")
+
+        class IB(model.Schema):
+            two = schema.Int(title=u"B")
+            one = schema.TextLine(title=u"A")
+
+        schemaDiff = diffSchemata(IA, IB)
+        self.assertTrue(schemaDiff['order'])
+        self.assertEqual({'added': [], 'removed': [], 'changed': {}},
+                         schemaDiff['fields'])
+
+    def test_diffModels_markers_and_tagged_values(self):
+        from plone.supermodel import diffModels
+        from plone.supermodel import loadString
+        from plone.supermodel.diff import diffFields
+
+        class IMarker(Interface):
+            pass
+
+        a = loadString(COMPILED_MODEL)
+        b = loadString(COMPILED_MODEL)
+        self.assertEqual({}, diffModels(a, b)['changed'])
+
+        alsoProvides(b.schema['choice'], IMarker)
+        self.assertEqual(
+            {'choice': ['markers']},
+            diffModels(a, b)['changed'][u""]['fields']['changed'])
+
+        a.schema['items'].setTaggedValue(u"tag", 1)
+        b.schema['items'].setTaggedValue(u"tag", 1)
+        self.assertEqual([], diffFields(a.schema['items'],
+                                        b.schema['items']))
+        b.schema['items'].setTaggedValue(u"tag", 2)
+        self.assertEqual(['taggedValues'],
+                         diffFields(a.schema['items'], b.schema['items']))
+
+    def test_diffFields_attribute_of_one_field(self):
+        from plone.supermodel.diff import diffFields
+        a = schema.TextLine(title=u"A")
+        b = schema.TextLine(title=u"A")
+        b.extra = 1
+        self.assertEqual(['extra'], diffFields(a, b))
+        self.assertEqual(['extra'], diffFields(b, a))
+
+    def test_diffFields(self):
+        from plone.supermodel.diff import diffFields
+        self.assertEqual([], diffFields(schema.TextLine(title=u"A"),
+                                        schema.TextLine(title=u"A")))
+        self.assertEqual(['type'], diffFields(schema.TextLine(title=u"A"),
+                                              schema.Text(title=u"A")))
+        self.assertEqual(['max_length', 'title'],
+                         diffFields(schema.TextLine(title=u"A"),
+                                    schema.TextLine(title=u"B", max_length=2)))
+
+
+
+class TestJSONModels(unittest.TestCase):
+
+    def setUp(self):
+        configure()
+        from plone.supermodel.interfaces import IFieldMetadataHandler
+        from plone.supermodel.security import SecuritySchema
+        from zope.component import provideUtility
+        provideUtility(SecuritySchema(), IFieldMetadataHandler,
+                       name=u"plone.supermodel.security")
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        _clearContext()
+
+    def test_roundtrip(self):
+        from plone.supermodel import diffModels
+        from plone.supermodel import loadJSON
+        from plone.supermodel import loadString
+        from plone.supermodel import serializeModel
+        from plone.supermodel import serializeModelJSON
+        import json
+        model = loadString(COMPILED_MODEL)
+        data = serializeModelJSON(model)
+        decoded = json.loads(data)
+        self.assertEqual(
+            {u"schemata": {u"": {
+                 u"based-on": [u"plone.supermodel.tests.IBase"],
+                 u"invariants": [u"plone.supermodel.tests.dummy_invariant"],
+                 u"fields": [
+                     {u"name": u"choice",
+                      u"type": u"zope.schema.Choice",
+                      u"title": {u"translate": u"Choice",
+                                 u"domain": u"plone.supermodel.tests"},
+                      u"values": [u"a", u"b"],
+                      u"metadata": [u"field", {
+                          u"security:read-permission": u"zope2.View"}]}],
+                 u"fieldsets": [
+                     {u"name": u"extra",
+                      u"label": u"Extra",
+                      u"fields": [
+                          {u"name": u"items",
+                           u"type": u"zope.schema.List",
+                           u"default": [u"1"],
+                           u"value_type": {u"type": u"zope.schema.Int"}}]}],
+             }}},
+            decoded)
+
+        for loaded in (loadJSON(data), loadJSON(data.encode('utf-8')),
+                       loadJSON(decoded)):
+            self.assertEqual({'added': [], 'removed': [], 'changed': {}},
+                             diffModels(model, loaded))
+            self.assertEqual(serializeModel(model), serializeModel(loaded))
+            self.assertEqual({u"choice": u"zope2.View"},
+                             loaded.schema.queryTaggedValue(
+                                 READ_PERMISSIONS_KEY))
+
+    def test_handwritten(self):
+        from plone.supermodel import loadJSON
+        model = loadJSON({u"schemata": {u"": {u"fields": [
+            {u"name": u"title", u"type": u"zope.schema.TextLine",
+             u"title": u"Title", u"max_length": 20, u"required": False,
+             u"metadata": [u"field", {
+                 u"security:write-permission": u"cmf.ModifyPortalContent"}]},
+            {u"name": u"tags", u"type": u"zope.schema.Dict",
+             u"key_type": {u"type": u"zope.schema.TextLine"},
+             u"value_type": {u"type": u"zope.schema.Int"},
+             u"default": {u"a": 1, u"b": u"2"}},
+        ]}}})
+        field = model.schema[u"title"]
+        self.assertTrue(isinstance(field, schema.TextLine))
+        self.assertEqual(u"Title", field.title)
+        self.assertEqual(20, field.max_length)
+        self.assertFalse(field.required)
+        self.assertEqual({u"a": 1, u"b": 2}, model.schema[u"tags"].default)
+        self.assertEqual({u"title": u"cmf.ModifyPortalContent"},
+                         model.schema.queryTaggedValue(WRITE_PERMISSIONS_KEY))
+
+    def test_element_fallback(self):
+        # Fields whose handler overrides the XML methods only are written
+        # as elements
+        from plone.supermodel import loadJSON
+        from plone.supermodel import serializeModelJSON
+        from plone.supermodel.exportimport import BaseHandler
+        from plone.supermodel.exportimport import supportsJSON
+        from plone.supermodel.interfaces import IFieldExportImportHandler
+        from zope.component import provideUtility
+        import json
+
+        class TextLineHandler(BaseHandler):
+
+            def write(self, field, name, type, elementName='field'):
+                element = super(TextLineHandler, self).write(
+                    field, name, type, elementName)
+                element.set('written', 'xml')
+                return element
+
+        handler = TextLineHandler(schema.TextLine)
+        self.assertFalse(supportsJSON(handler))
+        self.assertTrue(supportsJSON(BaseHandler(schema.TextLine)))
+        provideUtility(handler, IFieldExportImportHandler,
+                       name=u"zope.schema.TextLine")
+
+        class ISchema(Interface):
+            title = schema.TextLine(title=u"Title", default=u"x")
+        data = json.loads(serializeModelJSON(model.Model({u"": ISchema})))
+        fieldData = data[u"schemata"][u""][u"fields"][0]
+        self.assertEqual(
+            [u"field", {u"name": u"title", u"type": u"zope.schema.TextLine",
+                        u"written": u"xml"},
+             [u"default", u"x"], [u"title", u"Title"]],
+            fieldData[u"element"])
+        field = loadJSON(data).schema[u"title"]
+        self.assertEqual(u"Title", field.title)
+        self.assertEqual(u"x", field.default)
+
+    def test_errors(self):
+        from plone.supermodel import loadJSON
+        from plone.supermodel.parser import SupermodelParseError
+        self.assertRaises(SupermodelParseError, loadJSON, u"[")
+        self.assertRaises(SupermodelParseError, loadJSON, [u"model"])
+        self.assertRaises(SupermodelParseError, loadJSON, {u"schemata": {
+            u"": {u"fields": [{u"name": u"a"}]}}})
+        self.assertRaises(SupermodelParseError, loadJSON, {u"schemata": {
+            u"": {u"fields": [{u"name": u"a", u"type": u"foo.Bar"}]}}})
+        self.assertRaises(SupermodelParseError, loadJSON, {u"schemata": {
+            u"": {u"fields": [{u"name": u"a", u"type": u"zope.schema.Int",
+                               u"default": u"x"}]}}})
+
+
 def tearDown(*args):
     zope.component.testing.tearDown(*args)
     _clearContext()
@@ -582,8 +2079,23 @@ def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(TestUtils),
         unittest.makeSuite(TestValueToElement),
+        unittest.makeSuite(TestDateConverters),
+        unittest.makeSuite(TestFieldHandler),
         unittest.makeSuite(TestChoiceHandling),
         unittest.makeSuite(TestSchemaDirectives),
+        unittest.makeSuite(TestModelCache),
+        unittest.makeSuite(TestStringCache),
+        unittest.makeSuite(TestCompiledModels),
+        unittest.makeSuite(TestHandlerTable),
+        unittest.makeSuite(TestIterparse),
+        unittest.makeSuite(TestLoadFiles),
+        unittest.makeSuite(TestSerializerModes),
+        unittest.makeSuite(TestBenchmark),
+        unittest.makeSuite(TestFinalizeSchemas),
+        unittest.makeSuite(TestLazyModel),
+        unittest.makeSuite(TestFingerprint),
+        unittest.makeSuite(TestDiffModels),
+        unittest.makeSuite(TestJSONModels),
         doctest.DocFileSuite('schema.txt',
             setUp=zope.component.testing.setUp,
             tearDown=tearDown,
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 from lxml import etree
 from plone.supermodel.debug import parseinfo
+from plone.supermodel.debug import serializeinfo
 from plone.supermodel.interfaces import I18N_NAMESPACE
 from plone.supermodel.interfaces import IToUnicode
 from plone.supermodel.interfaces import XML_NAMESPACE
+from plone.supermodel.model import SchemaClass
+from plone.supermodel.model import taggedValuesGeneration
 from zope.i18nmessageid import Message
 from zope.interface import directlyProvidedBy
 from zope.interface import directlyProvides
+from zope.schema import Field
 from zope.schema.interfaces import ICollection
 from zope.schema.interfaces import IDict
 from zope.schema.interfaces import IField
 from zope.schema.interfaces import IFromUnicode
+import bisect
 import os.path
 import re
 import sys
@@ -20,6 +25,11 @@ try:
 except:
     from zope.schema.vocabulary import OrderedDict  # <py27
 
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2
+    MappingProxyType = None
+
 import sys
 if sys.version_info < (3,):
     text_type = unicode
@@ -71,38 +81,108 @@ def indent(node, level=0):
                     child.tail = "\n" + node_indent
 
 
-def prettyXML(tree):
-    indent(tree)
+def prettyXML(tree, native=False):
+    """Indent the tree and return it as a string. If native is True, the
+    tree is indented by lxml rather than by indent(), if lxml supports it.
+    """
+    if native and hasattr(etree, 'indent'):
+        etree.indent(tree, space="  ")
+    else:
+        indent(tree)
     return etree.tostring(tree)
 
 
+# Types whose constructors return an equal object when given an instance
+_immutableTypes = frozenset([
+    text_type, bytes, int, float, bool, tuple, frozenset,
+])
+
+
+def _noTypecast(value):
+    return value
+
+
+def _compileTypecast(typecast):
+    """Return a function that casts a value using the given _type of a
+    field, i.e. a callable or a sequence of them, the last one of which
+    that does not raise an exception is used. If none succeeds, the value
+    is returned unchanged.
+    """
+    if typecast is None:
+        return _noTypecast
+    if not isinstance(typecast, (list, tuple)):
+        typecast = (typecast, )
+    casts = [tc for tc in reversed(typecast) if callable(tc)]
+
+    if not casts:
+        return _noTypecast
+
+    if len(casts) == 1:
+        tc = casts[0]
+        immutable = tc in _immutableTypes
+
+        def cast(value):
+            if immutable and type(value) is tc:
+                # tc(value) would return an equal object
+                return value
+            try:
+                return tc(value)
+            except:
+                return value
+        return cast
+
+    def cast(value):
+        for tc in casts:
+            try:
+                return tc(value)
+            except:
+                pass
+        return value
+    return cast
+
+
+# Compiled typecasts by the _type of fields
+_typecasts = {}
+
+
 def fieldTypecast(field, value):
     typecast = getattr(field, '_type', None)
-    if typecast is not None:
-        if not isinstance(typecast, (list, tuple)):
-            typecast = (typecast, )
-        for tc in reversed(typecast):
-            if callable(tc):
-                try:
-                    value = tc(value)
-                    break
-                except:
-                    pass
-    return value
+    try:
+        cast = _typecasts[typecast]
+    except KeyError:
+        cast = _typecasts[typecast] = _compileTypecast(typecast)
+    except TypeError:
+        # Not hashable
+        cast = _compileTypecast(typecast)
+    return cast(value)
+
+
+def _valueConverter(field, interface):
+    """Return the converter for the values of a collection field, or None if
+    they are collections themselves or have no converter.
+    """
+    value_type = field.value_type
+    if value_type is None or IDict.providedBy(value_type) or \
+            ICollection.providedBy(value_type):
+        return None
+    return interface(value_type, None)
 
 
-def elementToValue(field, element, default=_marker):
+def elementToValue(field, element, default=_marker, converter=None):
     """Read the contents of an element that is assumed to represent a value
     allowable by the given field.
 
-    If converter is given, it should be an IToUnicode instance.
+    If converter is given, it should be an IFromUnicode instance.
 
     If not, the field will be adapted to this interface to obtain a converter.
+    For collections, the converter of the value type is obtained once and
+    used for all elements.
     """
     value = default
 
     if IDict.providedBy(field):
         key_converter = IFromUnicode(field.key_type)
+        value_converter = _valueConverter(field, IFromUnicode)
         value = OrderedDict()
         for child in element.iterchildren(tag=etree.Element):
             if noNS(child.tag.lower()) != 'element':
@@ -115,17 +195,20 @@ def elementToValue(field, element, default=_marker):
             else:
                 k = key_converter.fromUnicode(text_type(key_text))
 
-            value[k] = elementToValue(field.value_type, child)
+            value[k] = elementToValue(field.value_type, child,
+                                      converter=value_converter)
             parseinfo.stack.pop()
         value = fieldTypecast(field, value)
 
     elif ICollection.providedBy(field):
+        value_converter = _valueConverter(field, IFromUnicode)
         value = []
         for child in element.iterchildren(tag=etree.Element):
             if noNS(child.tag.lower()) != 'element':
                 continue
             parseinfo.stack.append(child)
-            v = elementToValue(field.value_type, child)
+            v = elementToValue(field.value_type, child,
+                               converter=value_converter)
             value.append(v)
             parseinfo.stack.pop()
         value = fieldTypecast(field, value)
@@ -136,7 +219,8 @@ def elementToValue(field, element, default=_marker):
         if text is None:
             value = field.missing_value
         else:
-            converter = IFromUnicode(field)
+            if converter is None:
+                converter = IFromUnicode(field)
             value = converter.fromUnicode(text_type(text))
 
         # handle i18n
@@ -153,7 +237,7 @@ def elementToValue(field, element, default=_marker):
     return value
 
 
-def valueToElement(field, value, name=None, force=False):
+def valueToElement(field, value, name=None, force=False, converter=None):
     """Create and return an element that describes the given value, which is
     assumed to be valid for the given field.
 
@@ -162,6 +246,11 @@ def valueToElement(field, value, name=None, force=False):
 
     If force is True, the value will always be written. Otherwise, it is only
     written if it is not equal to field.missing_value.
+
+    If converter is given, it should be an IToUnicode instance. If not, the
+    field will be adapted to this interface to obtain a converter. For
+    collections, the converter of the value type is obtained once and used
+    for all elements.
     """
 
     if name is None:
@@ -173,18 +262,23 @@ def valueToElement(field, value, name=None, force=False):
 
         if IDict.providedBy(field):
             key_converter = IToUnicode(field.key_type)
+            value_converter = _valueConverter(field, IToUnicode)
             for k, v in value.items():
-                list_element = valueToElement(field.value_type, v, 'element', force)
+                list_element = valueToElement(field.value_type, v, 'element',
+                                              force, value_converter)
                 list_element.attrib['key'] = key_converter.toUnicode(k)
                 child.append(list_element)
 
         elif ICollection.providedBy(field):
+            value_converter = _valueConverter(field, IToUnicode)
             for v in value:
-                list_element = valueToElement(field.value_type, v, 'element', force)
+                list_element = valueToElement(field.value_type, v, 'element',
+                                              force, value_converter)
                 child.append(list_element)
 
         else:
-            converter = IToUnicode(field)
+            if converter is None:
+                converter = IToUnicode(field)
             child.text = converter.toUnicode(value)
 
             # handle i18n
@@ -195,10 +289,134 @@ def valueToElement(field, value, name=None, force=False):
                 else:
                     child.set(ns('translate', I18N_NAMESPACE), child.text)
                     child.text = converter.toUnicode(value.default)
+                if serializeinfo.i18n_nodes is not None:
+                    serializeinfo.i18n_nodes.append(child)
 
     return child
 
 
+def jsonToValue(field, data, converter=None):
+    """Return the value represented by the given decoded JSON, as written by
+    valueToJSON(), for the given field.
+
+    Dicts are JSON objects and other collections are lists. Other values are
+    strings read with the IFromUnicode converter of the field, or the given
+    converter; JSON numbers and booleans are read from their text. A
+    message id is an object with its 'translate' msgid, 'domain' and
+    'default' text.
+    """
+    if data is None:
+        return field.missing_value
+
+    if IDict.providedBy(field):
+        key_converter = IFromUnicode(field.key_type)
+        value_converter = _valueConverter(field, IFromUnicode)
+        value = OrderedDict()
+        for k, v in data.items():
+            value[key_converter.fromUnicode(text_type(k))] = jsonToValue(
+                field.value_type, v, value_converter)
+        return fieldTypecast(field, value)
+
+    if ICollection.providedBy(field):
+        value_converter = _valueConverter(field, IFromUnicode)
+        value = [jsonToValue(field.value_type, v, value_converter)
+                 for v in data]
+        return fieldTypecast(field, value)
+
+    if converter is None:
+        converter = IFromUnicode(field)
+
+    if isinstance(data, dict):
+        msgid = data['translate']
+        default = data.get('default')
+        if default is None:
+            return Message(converter.fromUnicode(text_type(msgid)),
+                           domain=data.get('domain'))
+        return Message(msgid, domain=data.get('domain'),
+                       default=converter.fromUnicode(text_type(default)))
+
+    if isinstance(data, bool):
+        data = data and u'True' or u'False'
+    return converter.fromUnicode(text_type(data))
+
+
+def valueToJSON(field, value, force=False, converter=None):
+    """Return the JSON representation of the given value, which is assumed
+    to be valid for the given field, to be read by jsonToValue(). This is
+    None if the value is None or, unless force is True, equal to
+    field.missing_value.
+
+    If converter is given, it should be an IToUnicode instance. If not, the
+    field will be adapted to this interface to obtain a converter.
+    """
+    if value is None or (not force and value == field.missing_value):
+        return None
+
+    if IDict.providedBy(field):
+        key_converter = IToUnicode(field.key_type)
+        value_converter = _valueConverter(field, IToUnicode)
+        return OrderedDict(
+            (key_converter.toUnicode(k),
+             valueToJSON(field.value_type, v, force, value_converter))
+            for k, v in value.items()
+        )
+
+    if ICollection.providedBy(field):
+        value_converter = _valueConverter(field, IToUnicode)
+        return [valueToJSON(field.value_type, v, force, value_converter)
+                for v in value]
+
+    if converter is None:
+        converter = IToUnicode(field)
+
+    if isinstance(value, Message):
+        data = OrderedDict([('translate', text_type(value)),
+                            ('domain', value.domain)])
+        if value.default:
+            data['default'] = converter.toUnicode(value.default)
+        return data
+
+    return converter.toUnicode(value)
+
+
+_i18nRecordingClasses = {}
+
+
+def recordsI18n(handler):
+    """Return True if the write() method of a field or metadata handler
+    only adds i18n attributes through valueToElement(), which records the
+    elements in serializeinfo.i18n_nodes. This is declared by setting
+    i18nRecorded to True on the class that defines write().
+    """
+    cls = handler.__class__
+    try:
+        return _i18nRecordingClasses[cls]
+    except KeyError:
+        pass
+    result = False
+    for klass in cls.__mro__:
+        if 'write' in klass.__dict__:
+            result = klass.__dict__.get('i18nRecorded', False)
+            break
+    _i18nRecordingClasses[cls] = result
+    return result
+
+
+def recordI18nNodes(element, start):
+    """Replace the elements recorded in serializeinfo.i18n_nodes since the
+    list had start entries by those in the tree of element which have an
+    i18n:translate attribute, in document order. Used for elements written
+    by handlers for which recordsI18n() is False.
+    """
+    i18n_nodes = serializeinfo.i18n_nodes
+    if i18n_nodes is None:
+        return
+    del i18n_nodes[start:]
+    translate = ns('translate', I18N_NAMESPACE)
+    i18n_nodes.extend(node for node in element.iter(etree.Element)
+                      if translate in node.attrib)
+
+
 def relativeToCallingPackage(filename, callingFrame=2):
     """If the filename is not an absolute path, make it into an absolute path
     by calculating the relative path from the module that called the function
@@ -222,16 +440,50 @@ def relativeToCallingPackage(filename, callingFrame=2):
 
 def sortedFields(schema):
     """Like getFieldsInOrder, but does not include fields from bases
+
+    The result is cached for instances of SchemaClass, and is used for as
+    long as the schema has the same attribute objects and the fields have
+    the same order.
     """
+    if not isinstance(schema, SchemaClass):
+        return _sortedFields(schema)
+
+    attrs = schema.__dict__.get('_InterfaceClass__attrs')
+    items = tuple(attrs.items())
+    cached = schema.__dict__.get('_v_supermodel_sortedFields')
+    if cached is not None and len(cached[0]) == len(items) and all(
+        a[0] == b[0] and a[1] is b[1] for a, b in zip(cached[0], items)
+    ) and all(
+        item[1].order == order for item, order in zip(cached[2], cached[1])
+    ):
+        return list(cached[2])
+
+    fields = _sortedFields(schema)
+    schema._v_supermodel_sortedFields = (
+        items,
+        tuple([field.order for name, field in fields]),
+        tuple(fields),
+    )
+    return fields
+
+
+def _sortedFields(schema):
     fields = []
+    direct = getattr(schema, 'direct', schema.get)
     for name in schema.names(all=False):
-        field = schema[name]
+        field = direct(name)
         if IField.providedBy(field):
             fields.append((name, field, ))
     fields.sort(key=lambda item: item[1].order)
     return fields
 
 
+def invalidateSortedFields(schema):
+    """Drop the fields of the schema cached by sortedFields().
+    """
+    schema.__dict__.pop('_v_supermodel_sortedFields', None)
+
+
 def mergedTaggedValueDict(schema, name):
     """Look up the tagged value 'name' in schema and all its bases, assuming
     that the value under 'name' is a dict. Return a dict that consists of
@@ -256,12 +508,194 @@ def mergedTaggedValueList(schema, name):
     return tv
 
 
-def syncSchema(source, dest, overwrite=False, sync_bases=False):
+def _directTaggedValue(iface, name):
+    query = getattr(iface, 'queryDirectTaggedValue', None)
+    if query is None:
+        # zope.interface < 5 does not look up tagged values in bases
+        return iface.queryTaggedValue(name)
+    return query(name)
+
+
+def _cachedMergedTaggedValue(schema, name, merge):
+    """Return merge(schema, name), cached on the schema.
+
+    The cached value is used as long as the schema has the same resolution
+    order, no tagged value has been set on a SchemaClass in it since (see
+    model.taggedValuesChanged()), and the tagged values of other interfaces
+    in the resolution order are the same objects as before.
+    """
+    iro = schema.__iro__
+    generation = []
+    others = []
+    for iface in iro:
+        if isinstance(iface, SchemaClass):
+            generation.append(taggedValuesGeneration(iface))
+        else:
+            others.append(_directTaggedValue(iface, name))
+
+    cache = schema.__dict__.get('_v_supermodel_merged')
+    if cache is None:
+        cache = schema._v_supermodel_merged = {}
+
+    key = (merge, name)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == generation and entry[1] is iro and \
+            len(entry[2]) == len(others) and \
+            all(a is b for a, b in zip(entry[2], others)):
+        return entry[3]
+
+    value = merge(schema, name)
+    if isinstance(value, dict):
+        if MappingProxyType is not None:
+            value = MappingProxyType(value)
+    else:
+        value = tuple(value)
+    cache[key] = (generation, iro, others, value)
+    return value
+
+
+def cachedMergedTaggedValueDict(schema, name):
+    """Like mergedTaggedValueDict(), but the result is cached on the schema
+    until tagged values or bases change, and is read-only (a copy of the
+    cached dict on Python 2).
+
+    Changes made to tagged values in place are not noticed.
+    """
+    value = _cachedMergedTaggedValue(schema, name, mergedTaggedValueDict)
+    if MappingProxyType is None:
+        return dict(value)
+    return value
+
+
+def cachedMergedTaggedValueList(schema, name):
+    """Like mergedTaggedValueList(), but the result is cached on the schema
+    until tagged values or bases change, and is returned as a tuple.
+
+    Changes made to tagged values in place are not noticed.
+    """
+    return _cachedMergedTaggedValue(schema, name, mergedTaggedValueList)
+
+
+def _valuesEqual(a, b):
+    """Compare two tagged values structurally, in the same way as they are
+    compared for fingerprints.
+    """
+    from plone.supermodel.fingerprint import _canonical
+    return _canonical(a, frozenset()) == _canonical(b, frozenset())
+
+
+def _increasing(orders):
+    """Given a list of (key, order) pairs, return the keys of a longest
+    subsequence with increasing orders.
+    """
+    tails = []
+    tailPositions = []
+    parents = []
+    for position, (key, order) in enumerate(orders):
+        i = bisect.bisect_left(tails, order)
+        if i == len(tails):
+            tails.append(order)
+            tailPositions.append(position)
+        else:
+            tails[i] = order
+            tailPositions[i] = position
+        parents.append(tailPositions[i - 1] if i else None)
+
+    keys = set()
+    position = tailPositions[-1] if tailPositions else None
+    while position is not None:
+        keys.add(orders[position][0])
+        position = parents[position]
+    return keys
+
+
+def _newOrder():
+    # The next order of the field definition counter in zope.schema
+    Field.order += 1
+    return Field.order
+
+
+def _fieldOrders(source, dest):
+    """Return a dict mapping the names of the fields of source to the order
+    their copies in dest should have, for syncSchema(..., diff=True).
+
+    The orders of dest are kept for the largest set of its fields which are
+    already in the same relative order as in source, whether or not the
+    fields themselves have changed. The other fields get an order that
+    fits in between: the order they already have, the order of the source
+    field or the one next to a neighbour, if one of them fits, or else a
+    new one.
+    """
+    fields = sortedFields(source)
+    direct = getattr(dest, 'direct', dest.get)
+    current = {}
+    for name, field in fields:
+        field = direct(name)
+        if IField.providedBy(field):
+            current[name] = field.order
+    anchors = _increasing([(name, current[name]) for name, field in fields
+                           if name in current])
+
+    orders = {}
+    previous = None
+    for index, (name, field) in enumerate(fields):
+        order = current.get(name)
+        if name in anchors and (previous is None or order > previous):
+            orders[name] = previous = order
+            continue
+
+        following = None
+        for nextName, nextField in fields[index + 1:]:
+            if nextName in anchors:
+                following = current[nextName]
+                break
+
+        candidates = [order, field.order]
+        if previous is not None:
+            candidates.append(previous + 1)
+        elif following is not None:
+            candidates.append(following - 1)
+        for candidate in candidates:
+            if candidate is not None and \
+                    (previous is None or candidate > previous) and \
+                    (following is None or candidate < following):
+                break
+        else:
+            # The following fields of dest cannot keep their order
+            candidate = field.order
+            if previous is not None and candidate <= previous:
+                candidate = _newOrder()
+        orders[name] = previous = candidate
+    return orders
+
+
+def syncSchema(source, dest, overwrite=False, sync_bases=False, diff=False):
     """Copy attributes and tagged values from the source to the destination.
     If overwrite is False, do not overwrite attributes or tagged values that
     already exist or delete ones that don't exist in source.
+
+    If diff is True, fields and tagged values that are equal in source and
+    destination are left alone, and a dict describing the changes made is
+    returned, with lists of 'added', 'changed' and 'removed' field names,
+    a list of equal fields that were copied again because they had 'moved',
+    a list of changed 'taggedValues' and whether the 'bases' were changed.
+    Fields are compared by their fingerprints, so their absolute order does
+    not matter, only their position. Copies of changed fields take the
+    order of the fields they replace where possible (see _fieldOrders()).
     """
 
+    changes = {
+        'added': [],
+        'changed': [],
+        'moved': [],
+        'removed': [],
+        'taggedValues': [],
+        'bases': False,
+    }
+
+    # plone.supermodel.fingerprint imports this module
+    from plone.supermodel.fingerprint import fieldFingerprint
+
     if overwrite:
         to_delete = set()
 
@@ -273,33 +707,61 @@ def syncSchema(source, dest, overwrite=False, sync_bases=False):
         for name in to_delete:
             # delattr(dest, name)
             del dest._InterfaceClass__attrs[name]
-            if hasattr(dest, '_v_attrs'):
-                del dest._v_attrs[name]
+            if getattr(dest, '_v_attrs', None) is not None:
+                dest._v_attrs.pop(name, None)
+        if to_delete:
+            invalidateSortedFields(dest)
+        changes['removed'].extend(sorted(to_delete))
 
     # Add fields that are in source, but not in dest
 
+    orders = None
+    if diff and overwrite:
+        orders = _fieldOrders(source, dest)
+
     for name, field in sortedFields(source):
-        if overwrite or name not in dest or dest[name].interface is not dest:
+        if name not in dest or dest[name].interface is not dest:
+            changes['added'].append(name)
+        elif not overwrite:
+            continue
+        elif not diff:
+            changes['changed'].append(name)
+        elif fieldFingerprint(field) != fieldFingerprint(dest[name]):
+            changes['changed'].append(name)
+        elif orders[name] != dest[name].order:
+            changes['moved'].append(name)
+        else:
+            continue
 
-            clone = field.__class__.__new__(field.__class__)
-            clone.__dict__.update(field.__dict__)
-            clone.interface = dest
-            clone.__name__ = name
+        clone = field.__class__.__new__(field.__class__)
+        clone.__dict__.update(field.__dict__)
+        clone.interface = dest
+        clone.__name__ = name
+        if orders is not None:
+            clone.order = orders[name]
 
-            # copy any marker interfaces
-            directlyProvides(clone, *directlyProvidedBy(field))
+        # copy any marker interfaces
+        directlyProvides(clone, *directlyProvidedBy(field))
 
-            # setattr(dest, name, clone)
-            dest._InterfaceClass__attrs[name] = clone
-            if hasattr(dest, '_v_attrs'):
-                dest._v_attrs[name] = clone
+        # setattr(dest, name, clone)
+        dest._InterfaceClass__attrs[name] = clone
+        if getattr(dest, '_v_attrs', None) is not None:
+            dest._v_attrs[name] = clone
+        invalidateSortedFields(dest)
 
     # Copy tagged values
     dest_tags = set(dest.getTaggedValueTags())
     for tag in source.getTaggedValueTags():
         if overwrite or tag not in dest_tags:
             value = source.getTaggedValue(tag)
+            if diff:
+                query = getattr(dest, 'queryDirectTaggedValue',
+                                dest.queryTaggedValue)
+                current = query(tag, _marker)
+                if current is value or _valuesEqual(current, value):
+                    continue
             dest.setTaggedValue(tag, value)
+            changes['taggedValues'].append(tag)
 
     # Sync bases
     if sync_bases:
@@ -308,4 +770,11 @@ def syncSchema(source, dest, overwrite=False, sync_bases=False):
             for base in dest.__bases__:
                 if base not in bases:
                     bases.append(base)
-        dest.__bases__ = tuple(bases)
+        bases = tuple(bases)
+        if not diff or len(bases) != len(dest.__bases__) or \
+                any(a is not b for a, b in zip(bases, dest.__bases__)):
+            dest.__bases__ = bases
+            changes['bases'] = True
+
+    if diff:
+        return changes